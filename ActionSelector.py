@@ -0,0 +1,94 @@
+import numpy as np
+
+
+class ActionSelector:
+    """
+    Batched epsilon-greedy and softmax (Boltzmann) action selection.
+
+    Random numbers are drawn from an explicit numpy Generator in blocks and
+    handed out row by row, so selecting the action of a single state costs a
+    few array operations instead of a call into the random module or
+    Generator.choice. Softmax uses the Gumbel-max trick: the argmax of
+    q / temperature plus standard Gumbel noise is distributed exactly as
+    softmax(q / temperature), without computing exponentials that can overflow.
+
+    Attributes:
+        num_actions (int): The number of actions.
+        rng (np.random.Generator): The random generator the noise is drawn from.
+        block_size (int): The number of rows of noise drawn at once.
+    """
+
+    def __init__(self, num_actions, rng=None, block_size=4096):
+        """
+        Initializes the selector.
+
+        Args:
+            num_actions (int): The number of actions.
+            rng (np.random.Generator | int, optional): The random generator, or a seed for a new one.
+            block_size (int, optional): The number of rows of noise drawn at once. Default is 4096.
+        """
+        self.num_actions = num_actions
+        self.rng = rng if isinstance(rng, np.random.Generator) else np.random.default_rng(rng)
+        self.block_size = block_size
+        self._blocks = {}
+
+    def _draw(self, kind, n):
+        """
+        Returns the next n rows of pre-drawn noise of the given kind.
+
+        Args:
+            kind (str): 'gumbel' (one value per action), 'uniform' or 'action'.
+            n (int): The number of rows.
+
+        Returns:
+            np.ndarray: The noise, shape (n, num_actions) for 'gumbel' and (n,) otherwise.
+        """
+        block, position = self._blocks.get(kind, (None, 0))
+        if block is None or position + n > len(block):
+            size = max(self.block_size, n)
+            if kind == 'gumbel':
+                block = self.rng.gumbel(size=(size, self.num_actions))
+            elif kind == 'uniform':
+                block = self.rng.random(size)
+            else:
+                block = self.rng.integers(0, self.num_actions, size)
+            position = 0
+        self._blocks[kind] = (block, position + n)
+        return block[position:position + n]
+
+    def softmax(self, q_values, temperature):
+        """
+        Samples actions with probabilities proportional to exp(q / temperature).
+
+        Args:
+            q_values (np.ndarray): The action values of one state, shape (num_actions,),
+                or of many states, shape (n, num_actions).
+            temperature (float): The temperature; lower is greedier.
+
+        Returns:
+            int | np.ndarray: The action, or one action per state.
+        """
+        q_values = np.asarray(q_values)
+        noise = self._draw('gumbel', 1 if q_values.ndim == 1 else len(q_values))
+        actions = np.argmax(q_values / temperature + noise, axis=-1)
+        return int(actions[0]) if q_values.ndim == 1 else actions
+
+    def epsilon_greedy(self, q_values, epsilon):
+        """
+        Takes a uniformly random action with probability epsilon and the greedy one otherwise.
+
+        Args:
+            q_values (np.ndarray): The action values of one state, shape (num_actions,),
+                or of many states, shape (n, num_actions).
+            epsilon (float): The exploration probability.
+
+        Returns:
+            int | np.ndarray: The action, or one action per state.
+        """
+        q_values = np.asarray(q_values)
+        if q_values.ndim == 1:
+            if self._draw('uniform', 1)[0] < epsilon:
+                return int(self._draw('action', 1)[0])
+            return int(np.argmax(q_values))
+        n = len(q_values)
+        return np.where(self._draw('uniform', n) < epsilon, self._draw('action', n), np.argmax(q_values, axis=1))
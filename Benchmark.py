@@ -0,0 +1,408 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from GridGenerator import GridGenerator
+from GridWorldBuilder import Grid, GridWorldBuilder
+from MDP import ValueIteration, PolicyIteration, ModifiedPolicyIteration, MultigridValueIteration
+from MBRL import ModelBasedRL
+from MFRL import ModelFreeRL, DynaQ, TDLambda, NStepTD
+from VecEnv import VecEnv
+
+SIZES = (16, 64, 256)
+
+# Metrics where larger is worse, and where smaller is worse.
+COSTS = ('build', 'sweep', 'converge', 'env_steps', 'peak_bytes')
+RATES = ('steps_per_second',)
+
+
+def _planner(solver, **kwargs):
+    return lambda grid, discount_factor, theta: solver(grid, discount_factor, theta, **kwargs)
+
+
+# Every configuration with the largest number of states it is run on, None for no limit.
+PLANNERS = {
+    'ValueIteration.sync': (_planner(ValueIteration, backup='sync'), None),
+    'ValueIteration.gauss-seidel': (_planner(ValueIteration, backup='gauss-seidel'), 4096),
+    'ValueIteration.prioritized': (_planner(ValueIteration, backup='prioritized'), None),
+    'PolicyIteration': (_planner(PolicyIteration), 4096),
+    'ModifiedPolicyIteration': (_planner(ModifiedPolicyIteration), None),
+    'MultigridValueIteration': (_planner(MultigridValueIteration), None),
+}
+
+
+def _learner(agent, **kwargs):
+    return lambda grid, discount_factor, seed, metrics: agent(grid, discount_factor, epsilon=0.1, learning_rate=0.1,
+                                                              max_steps=1000, seed=seed, metrics=metrics, **kwargs)
+
+
+# Every learner whose convergence is measured with the largest number of states it is run on.
+LEARNERS = {
+    'converge.ModelFreeRL': (_learner(ModelFreeRL), 256),
+    'converge.DynaQ': (_learner(DynaQ), 256),
+    'converge.QLambda': (_learner(TDLambda, method='q'), 256),
+    'converge.SarsaLambda': (_learner(TDLambda, method='sarsa'), 256),
+    'converge.NStepQ': (_learner(NStepTD, method='q'), 256),
+    'converge.NStepSarsa': (_learner(NStepTD, method='sarsa'), 256),
+}
+SOLVERS = (('Grid', 'VecEnv') + tuple(PLANNERS) + ('ModelFreeRL', 'ModelBasedRL', 'Precision', 'Multigrid')
+           + tuple(LEARNERS))
+
+# The grid worlds the sweeps of MultigridValueIteration are compared on.
+MULTIGRID_MAPS = {
+    'cliff': lambda size, seed: GridGenerator(seed).cliff(size, size),
+    'obstacles': lambda size, seed: GridGenerator(seed).obstacles(size, size),
+    'maze': lambda size, seed: GridGenerator(seed).maze(size + 1, size + 1),
+}
+
+
+def measure(function, repeat=1, memory=False):
+    """
+    Times a function, and optionally measures its peak of traced memory.
+
+    The memory is measured in a separate call, as tracing slows the function down.
+
+    Args:
+        function (callable): The function to measure, called without arguments.
+        repeat (int): The number of timed calls; the fastest one counts.
+        memory (bool): Whether to measure the memory peak as well.
+
+    Returns:
+        tuple: The seconds of the fastest call, the peak in bytes (or None) and the result of the last call.
+    """
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds = min(seconds, time.perf_counter() - start)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return seconds, peak, result
+
+
+def bench_planner(name, grid, discount_factor, theta, repeat):
+    """
+    Measures building a planner, one sweep of it and its convergence.
+
+    Returns:
+        dict: The metrics.
+    """
+    factory = PLANNERS[name][0]
+    build, _, _ = measure(lambda: factory(grid, discount_factor, theta), repeat)
+    metrics = {'build': build}
+    if name.startswith('ValueIteration.') and name != 'ValueIteration.prioritized':
+        metrics['sweep'], _, _ = measure(lambda: factory(grid, discount_factor, theta).one_iteration(), repeat)
+
+    def converge():
+        solver = factory(grid, discount_factor, theta)
+        solver.train()
+        return solver
+
+    metrics['converge'], metrics['peak_bytes'], solver = measure(converge, repeat, memory=True)
+    metrics['iterations'] = len(solver.delta_history)
+    return metrics
+
+
+def bench_learner(name, grid, discount_factor, repeat, steps=100, num_envs=256, seed=0):
+    """
+    Measures the throughput of a learning agent.
+
+    ModelFreeRL is timed on train_vectorized. ModelBasedRL is timed on
+    estimating its model from steps * num_envs random transitions (build) and
+    solving that model (converge).
+
+    Returns:
+        dict: The metrics.
+    """
+    if name == 'ModelFreeRL':
+        agent = ModelFreeRL(grid, discount_factor, seed=seed)
+        seconds, peak, _ = measure(lambda: agent.train_vectorized(steps, num_envs, seed), repeat, memory=True)
+        return {'steps_per_second': steps * num_envs / seconds, 'peak_bytes': peak}
+    agent = ModelBasedRL(grid, discount_factor, seed=seed)
+    env = VecEnv(agent.step_table, agent.reward_vector, agent.start_excluded, num_envs, seed)
+    experience = []
+    for _ in range(steps):
+        states = env.states
+        actions = env.rng.integers(0, grid.num_actions, num_envs)
+        next_states, rewards, _ = env.step(actions)
+        experience.extend(zip(states, actions, rewards, next_states))
+    build, _, (T, R) = measure(lambda: agent.learn_mdp_from_experience(experience), repeat)
+    converge, peak, _ = measure(lambda: agent.value_iteration(T, R), repeat, memory=True)
+    return {'build': build, 'converge': converge, 'peak_bytes': peak}
+
+
+def deterministic_values(agent, discount_factor, policy=None, tolerance=1e-10):
+    """
+    Evaluates a policy, or solves for the optimal values, in the deterministic grid world the learning agents see.
+
+    The agents move by their step_table, receive the reward of the state they
+    reach and stop at their terminal states. The iteration runs in float64.
+
+    Args:
+        agent (ModelFreeRL): The agent.
+        discount_factor (float): The discount factor.
+        policy (np.ndarray, optional): The action of every state, in the agent's action order.
+            Default is the optimal policy.
+        tolerance (float): The largest value change at which the iteration stops.
+
+    Returns:
+        np.ndarray: The value of every state of the agent, 0 in terminal states.
+    """
+    next_states = agent.step_table
+    if policy is not None:
+        next_states = next_states[np.arange(agent.num_states), policy][:, None]
+    rewards = np.asarray(agent.reward_vector, dtype=float)[next_states]
+    values = np.zeros(agent.num_states)
+    while True:
+        backup = np.where(agent.terminal, 0, np.max(rewards + discount_factor * values[next_states], axis=1))
+        if np.max(np.abs(backup - values)) < tolerance:
+            return backup
+        values = backup
+
+
+def bench_convergence(name, grid, discount_factor, seed=0, tolerance=0.1, max_episodes=2000, chunk=10):
+    """
+    Measures how long a learner takes until its greedy policy is within tolerance of the optimal one.
+
+    The learner is trained chunk episodes at a time, for at most max_episodes
+    episodes. After every chunk its greedy policy is evaluated exactly, and
+    the regret is the most value any state loses by following it. SARSA
+    learners converge to the values of their epsilon-greedy policy, whose
+    greedy policy can keep some regret.
+
+    Returns:
+        dict: The metrics: converge (the training seconds), episodes, env_steps, the remaining
+            max_regret and converged (1 when the tolerance was reached, 0 when the budget ran out).
+    """
+    lengths = []
+    agent = LEARNERS[name][0](grid, discount_factor, seed, lambda event, fields: lengths.append(fields['length']))
+    reference = deterministic_values(agent, discount_factor)
+    live = ~agent.terminal
+    agent.episodes = chunk
+    seconds, episodes, regret = 0, 0, float('inf')
+    while episodes < max_episodes and regret > tolerance:
+        start = time.perf_counter()
+        agent.train()
+        seconds += time.perf_counter() - start
+        episodes += chunk
+        values = deterministic_values(agent, discount_factor, np.argmax(agent.q_values, axis=1))
+        regret = float(np.max(reference[live] - values[live]))
+    return {'converge': seconds, 'episodes': episodes, 'env_steps': sum(lengths), 'max_regret': regret,
+            'converged': int(regret <= tolerance)}
+
+
+def evaluate_policy(grid, policy, discount_factor, tolerance=1e-10):
+    """
+    Evaluates a policy in float64 by iterating its Bellman equation to the given tolerance.
+
+    Args:
+        grid (Grid): The grid world, in float64.
+        policy (np.ndarray): The action of every grid state.
+        discount_factor (float): The discount factor.
+        tolerance (float): The largest value change at which the iteration stops.
+
+    Returns:
+        np.ndarray: The value of every grid state under the policy.
+    """
+    solver = PolicyIteration(grid, discount_factor)
+    next_states, probs = solver.policy_transition(np.asarray(policy)[solver.compact.states])
+    values = solver.terminal_values()
+    live = ~solver.terminal
+    while True:
+        backup = np.sum(probs * (solver.reward_function[:, None] + discount_factor * values[next_states]), axis=1)
+        delta = np.max(np.abs(backup - values)[live], initial=0)
+        values[live] = backup[live]
+        if delta < tolerance:
+            return solver.compact.scatter(values)
+
+
+def bench_precision(definition, discount_factor, theta, dtype=np.float32):
+    """
+    Checks value iteration in a reduced precision against float64 on the same grid world.
+
+    Both greedy policies are evaluated in float64, so max_regret is the most
+    value any state loses by following the reduced-precision policy.
+
+    Returns:
+        dict: max_value_error, policy_agreement (the fraction of live states with the same action)
+            and max_regret.
+    """
+    exact = Grid(definition)
+    solvers = [ValueIteration(grid, discount_factor, theta, backup='sync')
+               for grid in (exact, Grid(definition, dtype=dtype))]
+    for solver in solvers:
+        solver.train()
+    live = ~exact.terminal
+    reference, reduced = (evaluate_policy(exact, solver.policy, discount_factor) for solver in solvers)
+    return {'max_value_error': float(np.max(np.abs(solvers[1].values - solvers[0].values))),
+            'policy_agreement': float(np.mean(solvers[1].policy[live] == solvers[0].policy[live])),
+            'max_regret': float(np.max(reference[live] - reduced[live], initial=0))}
+
+
+def bench_multigrid(size, discount_factor, theta, seed=0, dtype=np.float64):
+    """
+    Compares the sweeps of MultigridValueIteration with those of synchronous value iteration.
+
+    On every map of MULTIGRID_MAPS, sweeps counts the sweeps of
+    ValueIteration(backup='sync'), fine_sweeps the sweeps multigrid still
+    needs on the full grid after its coarse levels, and work the states it
+    backs up on all levels, in sweeps of the full grid.
+
+    Returns:
+        dict: {map}.sweeps, {map}.fine_sweeps and {map}.work for every map.
+    """
+    metrics = {}
+    for kind, generate in MULTIGRID_MAPS.items():
+        grid = Grid(GridWorldBuilder(grids=[generate(size, seed)]).grids[0], dtype=dtype)
+        plain = ValueIteration(grid, discount_factor, theta, backup='sync')
+        plain.train()
+        backups = []
+        multigrid = MultigridValueIteration(grid, discount_factor, theta,
+                                            metrics=lambda event, fields: backups.append(fields['states']))
+        multigrid.train()
+        metrics[f'{kind}.sweeps'] = len(plain.delta_history)
+        metrics[f'{kind}.fine_sweeps'] = len(multigrid.delta_history)
+        metrics[f'{kind}.work'] = sum(backups) / multigrid.num_states
+    return metrics
+
+
+def run(sizes=SIZES, solvers=SOLVERS, discount_factor=0.9, theta=0.01, repeat=3, seed=0, dtype=np.float64, log=None):
+    """
+    Runs the benchmark on a ladder of square grid worlds with random obstacles.
+
+    The convergence of the learners (LEARNERS) is measured on cliff corridors
+    as wide as the grid worlds and a quarter as high instead, and Multigrid
+    on the maps of MULTIGRID_MAPS.
+
+    Args:
+        sizes (list): The side lengths of the grid worlds.
+        solvers (list): The configurations to run, see SOLVERS.
+        discount_factor (float): The discount factor of every solver.
+        theta (float): The convergence threshold of every planner.
+        repeat (int): The number of timed runs per measurement; the fastest one counts.
+        seed (int): Seed of the grid worlds and the agents.
+        dtype (optional): The floating point type of the grid worlds and solvers. Precision always
+            compares float32 with float64. Default is float64.
+        log (callable): Called with every result as it is measured.
+
+    Returns:
+        dict: The run settings under 'meta' and a list of results under 'results'.
+    """
+    for name in solvers:
+        if name not in SOLVERS:
+            raise ValueError(f"Unknown solver {name!r}, expected one of {SOLVERS}")
+    results = []
+    for size in sizes:
+        definition = GridWorldBuilder(grids=[GridGenerator(seed).obstacles(size, size)]).grids[0]
+        grid = Grid(definition, dtype=dtype)
+        cliff = None
+        for name in solvers:
+            target = grid
+            if name in LEARNERS:
+                if cliff is None:
+                    cliff = Grid(GridWorldBuilder(grids=[GridGenerator(seed).cliff(size, max(3, size // 4))]).grids[0],
+                                 dtype=dtype)
+                target = cliff
+            limit = PLANNERS[name][1] if name in PLANNERS else LEARNERS[name][1] if name in LEARNERS else None
+            if limit is not None and target.num_states > limit:
+                continue
+            if name == 'Grid':
+                build, peak, grid = measure(lambda: Grid(definition, dtype=dtype), repeat, memory=True)
+                metrics = {'build': build, 'peak_bytes': peak, 'nbytes': grid.nbytes}
+            elif name == 'VecEnv':
+                env = VecEnv(grid.moves, grid.reward_table, grid.terminal, 256, seed)
+                actions = np.zeros(256, dtype=int)
+                seconds, _, _ = measure(lambda: [env.step(actions) for _ in range(1000)], repeat)
+                metrics = {'steps_per_second': 1000 * 256 / seconds}
+            elif name in PLANNERS:
+                metrics = bench_planner(name, grid, discount_factor, theta, repeat)
+            elif name == 'Precision':
+                metrics = bench_precision(definition, discount_factor, theta)
+            elif name == 'Multigrid':
+                metrics = bench_multigrid(size, discount_factor, theta, seed, dtype)
+            elif name in LEARNERS:
+                metrics = bench_convergence(name, cliff, discount_factor, seed)
+            else:
+                metrics = bench_learner(name, grid, discount_factor, repeat, seed=seed)
+            result = {'solver': name, 'size': size, 'states': target.num_states, 'metrics': metrics}
+            results.append(result)
+            if log:
+                log(result)
+    meta = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'sizes': list(sizes), 'discount_factor': discount_factor, 'theta': theta, 'repeat': repeat,
+            'seed': seed, 'dtype': np.dtype(dtype).name}
+    return {'meta': meta, 'results': results}
+
+
+def compare(baseline, current, threshold=0.2):
+    """
+    Compares two benchmark runs and lists the metrics that got worse by more than threshold.
+
+    Args:
+        baseline (dict): The stored run, as returned by run().
+        current (dict): The new run.
+        threshold (float): The tolerated relative slowdown, e.g. 0.2 for 20%.
+
+    Returns:
+        list: (solver, size, metric, baseline value, current value, ratio) of every regression,
+            where ratio > 1 means worse.
+    """
+    stored = {(result['solver'], result['size']): result['metrics'] for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        old = stored.get((result['solver'], result['size']))
+        if old is None:
+            continue
+        for metric, value in result['metrics'].items():
+            if metric not in old or not old[metric] or not value:
+                continue
+            if metric in COSTS:
+                ratio = value / old[metric]
+            elif metric in RATES:
+                ratio = old[metric] / value
+            else:
+                continue
+            if ratio > 1 + threshold:
+                regressions.append((result['solver'], result['size'], metric, old[metric], value, ratio))
+    return regressions
+
+
+def _format(result):
+    metrics = ' '.join(f'{key}={value:.4g}' for key, value in result['metrics'].items())
+    return f"{result['solver']:<28} {result['size']:>5}  {metrics}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the solvers on a ladder of grid sizes.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES), help='side lengths of the grid worlds')
+    parser.add_argument('--solvers', nargs='+', default=list(SOLVERS), choices=SOLVERS)
+    parser.add_argument('--discount', type=float, default=0.9, help='discount factor of every solver')
+    parser.add_argument('--theta', type=float, default=0.01, help='convergence threshold of every planner')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per measurement, the fastest counts')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dtype', default='float64', choices=('float64', 'float32'),
+                        help='floating point type of the grid worlds and solvers')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', metavar='BASELINE', help='flag slowdowns against a stored JSON run')
+    parser.add_argument('--threshold', type=float, default=0.2, help='tolerated relative slowdown (default: 0.2)')
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.solvers, args.discount, args.theta, args.repeat, args.seed, args.dtype,
+                 log=lambda result: print(_format(result)))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=1)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), report, args.threshold)
+        for solver, size, metric, old, new, ratio in regressions:
+            print(f'SLOWER {solver} size {size} {metric}: {old:.4g} -> {new:.4g} ({ratio:.2f}x)')
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+class GridCache:
+    """
+    On-disk cache of compiled grid worlds.
+
+    Every grid world is stored as a directory of .npy files named after the
+    content hash of its definition and its floating point type. Arrays are
+    loaded memory-mapped, so processes that open the same grid world share its
+    pages instead of each building a private copy. The (x, y, value) list L
+    of the definition is stored as well, so a DefinitionFile can skip parsing
+    it on a cache hit.
+
+    Attributes:
+        directory (str): The cache directory.
+        FORMAT (int): Version of the stored layout, part of every entry name.
+        ARRAYS (tuple): The names of the stored arrays.
+    """
+
+    FORMAT = 4
+    ARRAYS = ('map', 'moves', 'terminal', 'reward_table', 'L_positions', 'L_values')
+
+    def __init__(self, directory):
+        """
+        Initializes the cache, creating its directory if needed.
+
+        Args:
+            directory (str): The cache directory.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """
+        Returns the directory of the entry with the given content hash.
+        """
+        return os.path.join(self.directory, f'{key}.v{self.FORMAT}')
+
+    def load(self, key):
+        """
+        Loads a compiled grid world memory-mapped and read-only.
+
+        Args:
+            key (str): The content hash of the grid world definition and its floating point type.
+
+        Returns:
+            dict: The arrays by name, or None when the grid world is not cached.
+        """
+        path = self.path(key)
+        if not os.path.isdir(path):
+            return None
+        return {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in self.ARRAYS}
+
+    def save(self, key, arrays):
+        """
+        Stores a compiled grid world.
+
+        The entry is written to a temporary directory and renamed into place, so
+        concurrent writers never expose a partial entry; the first one wins.
+
+        Args:
+            key (str): The content hash of the grid world definition and its floating point type.
+            arrays (dict): The arrays by name, see ARRAYS.
+        """
+        staging = tempfile.mkdtemp(dir=self.directory)
+        for name in self.ARRAYS:
+            np.save(os.path.join(staging, f'{name}.npy'), np.ascontiguousarray(arrays[name]))
+        try:
+            os.rename(staging, self.path(key))
+        except OSError:
+            shutil.rmtree(staging)
@@ -0,0 +1,205 @@
+import argparse
+import numpy as np
+
+
+class GridGenerator:
+    """
+    Procedural generator of grid world definitions.
+
+    Definitions use the same w, h, L, p and r keys as the definitions file,
+    plus a name, and can be passed to GridWorldBuilder(grids=...) directly or
+    written out with write(). Maps are built as arrays, so sizes of millions
+    of cells are generated in well under a second.
+
+    Attributes:
+        KINDS (tuple): The names of the map generators.
+        rng (np.random.Generator): The random generator, seeded for reproducible maps.
+    """
+
+    KINDS = ('obstacles', 'maze', 'cliff', 'multi_goal')
+
+    def __init__(self, seed=None):
+        """
+        Initializes the generator.
+
+        Args:
+            seed (int, optional): Seed of the random generator. The same seed gives the same maps.
+        """
+        self.rng = np.random.default_rng(seed)
+
+    def generate(self, kind, w, h, **kwargs):
+        """
+        Generates a grid world of the given kind.
+
+        Args:
+            kind (str): One of KINDS.
+            w (int): The width of the grid world.
+            h (int): The height of the grid world.
+            **kwargs: Further arguments of the generator.
+
+        Returns:
+            dict: The grid world definition.
+        """
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown kind {kind!r}, expected one of {self.KINDS}")
+        return getattr(self, kind)(w, h, **kwargs)
+
+    def obstacles(self, w, h, density=0.2, p=0.8, r=-1):
+        """
+        Generates a grid world with randomly placed walls and a single goal.
+
+        Walls are drawn independently per cell, so parts of the grid world may
+        be cut off from the goal.
+
+        Args:
+            w (int): The width of the grid world.
+            h (int): The height of the grid world.
+            density (float, optional): The probability of a cell being a wall. Default is 0.2.
+            p (float, optional): The probability of moving as intended. Default is 0.8.
+            r (float, optional): The step reward. Default is -1.
+
+        Returns:
+            dict: The grid world definition.
+        """
+        return self.multi_goal(w, h, goals=1, pits=0, density=density, goal_rewards=(1, 1), p=p, r=r,
+                               name=f'obstacles-{w}x{h}')
+
+    def maze(self, w, h, p=0.8, r=-1):
+        """
+        Generates a perfect maze with the goal in the upper right room.
+
+        Rooms lie on odd rows and columns, separated by walls. Every room opens
+        to the room above or to its right (the binary tree algorithm), which is
+        drawn for all rooms at once and connects every room to the goal.
+
+        Args:
+            w (int): The width of the grid world, at least 3. Odd widths avoid a double outer wall.
+            h (int): The height of the grid world, at least 3. Odd heights avoid a double outer wall.
+            p (float, optional): The probability of moving as intended. Default is 0.8.
+            r (float, optional): The step reward. Default is -1.
+
+        Returns:
+            dict: The grid world definition.
+        """
+        if w < 3 or h < 3:
+            raise ValueError(f"A maze needs at least 3x3 cells, got {w}x{h}")
+        rows, cols = (h - 1) // 2, (w - 1) // 2
+        walls = np.ones((h, w), dtype=bool)
+        walls[1:2 * rows:2, 1:2 * cols:2] = False
+        north = self.rng.random((rows, cols)) < 0.5
+        north[0, :] = False
+        north[:, -1] = True
+        north[0, -1] = False
+        east = ~north
+        east[:, -1] = False
+        i, j = np.nonzero(north)
+        walls[2 * i, 2 * j + 1] = False
+        i, j = np.nonzero(east)
+        walls[2 * i + 1, 2 * j + 2] = False
+        rewards = np.zeros((h, w), dtype=int)
+        rewards[1, 2 * cols - 1] = 1
+        return self._definition(f'maze-{w}x{h}', walls, rewards, p, r)
+
+    def cliff(self, w, h, p=0.8, r=-1, fall=-100, goal=1):
+        """
+        Generates a cliff corridor as in t4: the bottom row between the lower
+        left start and the lower right goal is a cliff.
+
+        Args:
+            w (int): The width of the grid world, at least 3.
+            h (int): The height of the grid world.
+            p (float, optional): The probability of moving as intended. Default is 0.8.
+            r (float, optional): The step reward. Default is -1.
+            fall (float, optional): The reward of falling off the cliff. Default is -100.
+            goal (float, optional): The reward of the goal. Default is 1.
+
+        Returns:
+            dict: The grid world definition.
+        """
+        if w < 3:
+            raise ValueError(f"A cliff needs a width of at least 3, got {w}")
+        walls = np.zeros((h, w), dtype=bool)
+        rewards = np.zeros((h, w), dtype=type(fall + goal))
+        rewards[-1, 1:-1] = fall
+        rewards[-1, -1] = goal
+        return self._definition(f'cliff-{w}x{h}', walls, rewards, p, r)
+
+    def multi_goal(self, w, h, goals=4, pits=4, density=0.1, goal_rewards=(1, 10), pit_reward=-10, p=0.8, r=-1,
+                   name=None):
+        """
+        Generates a grid world with random walls, several goals of different value and pits.
+
+        Args:
+            w (int): The width of the grid world.
+            h (int): The height of the grid world.
+            goals (int, optional): The number of goals. Default is 4.
+            pits (int, optional): The number of pits. Default is 4.
+            density (float, optional): The probability of a cell being a wall. Default is 0.1.
+            goal_rewards (tuple, optional): The inclusive range of the integer goal rewards. Default is (1, 10).
+            pit_reward (float, optional): The reward of falling into a pit. Default is -10.
+            p (float, optional): The probability of moving as intended. Default is 0.8.
+            r (float, optional): The step reward. Default is -1.
+            name (str, optional): The name of the grid world. Default is derived from the size.
+
+        Returns:
+            dict: The grid world definition.
+        """
+        walls = self.rng.random((h, w)) < density
+        free = np.flatnonzero(~walls)
+        if goals + pits > free.size:
+            raise ValueError(f"Cannot place {goals + pits} terminals on {free.size} free cells")
+        cells = self.rng.choice(free, goals + pits, replace=False)
+        rewards = np.zeros(h * w, dtype=type(goal_rewards[0] + pit_reward))
+        rewards[cells[:goals]] = self.rng.integers(goal_rewards[0], goal_rewards[1] + 1, goals)
+        rewards[cells[goals:]] = pit_reward
+        return self._definition(name or f'multi_goal-{w}x{h}', walls, rewards.reshape(h, w), p, r)
+
+    @staticmethod
+    def _definition(name, walls, rewards, p, r):
+        """
+        Turns wall and terminal reward arrays into a grid world definition.
+
+        Args:
+            name (str): The name of the grid world.
+            walls (np.ndarray): Whether each cell is a wall, shape (h, w) with row 0 at the top.
+            rewards (np.ndarray): The reward of each terminal cell and 0 elsewhere, shape (h, w).
+            p (float): The probability of moving as intended.
+            r (float): The step reward.
+
+        Returns:
+            dict: The grid world definition.
+        """
+        h, w = walls.shape
+        rows, cols = np.nonzero(walls | (rewards != 0))
+        values = np.where(walls[rows, cols], 0, rewards[rows, cols])
+        L = list(zip(cols.tolist(), (h - 1 - rows).tolist(), values.tolist()))
+        return {'name': name, 'w': w, 'h': h, 'L': L, 'p': p, 'r': r}
+
+    @staticmethod
+    def write(grids, filename):
+        """
+        Writes grid world definitions in the format of the definitions file.
+
+        Args:
+            grids (list): The grid world definitions.
+            filename (str): The file to write.
+        """
+        with open(filename, 'w') as file:
+            for grid in grids:
+                file.write(f"#{grid.get('name') or ''}\n")
+                file.write(f"w = {grid['w']}\nh = {grid['h']}\n")
+                file.write("L = [" + ",".join(f"({x},{y},{value})" for x, y, value in grid['L']) + "]\n")
+                file.write(f"p = {grid['p']}\nr = {grid['r']}\n\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate grid world definitions.')
+    parser.add_argument('kind', choices=GridGenerator.KINDS)
+    parser.add_argument('w', type=int)
+    parser.add_argument('h', type=int)
+    parser.add_argument('--count', type=int, default=1, help='number of grid worlds to generate')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', required=True, help='definitions file to write')
+    args = parser.parse_args()
+    generator = GridGenerator(args.seed)
+    GridGenerator.write([generator.generate(args.kind, args.w, args.h) for _ in range(args.count)], args.output)
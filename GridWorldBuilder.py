@@ -1,29 +1,284 @@
 import numpy as np
 import ast
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-class GridWorldBuilder:
+import hashlib
+import itertools
+from collections import OrderedDict
+from types import MappingProxyType
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import breadth_first_order
+from GridCache import GridCache
+
+
+def index_dtype(bound):
     """
-    Class for building and managing grid worlds for reinforcement learning tasks.
+    Returns the smallest integer type, of int32 and int64, that holds indices up to bound.
+
+    int32 is the floor. NumPy converts every narrower-than-intp index array to
+    intp when it indexes with it, so int16 gathers are no faster than int32
+    ones. int16 would only pay off for grid worlds below 8192 states, whose
+    tables are small anyway. Unsigned types cannot hold the -1 of the walls
+    in the compact index.
+
+    Args:
+        bound (int): The largest index, e.g. num_states * num_actions for flat (state, action) indices.
+
+    Returns:
+        np.dtype: The index type.
+    """
+    return np.dtype(np.int32 if bound <= np.iinfo(np.int32).max else np.int64)
+
+
+class SparseTransition:
+    """
+    Fixed-width sparse transition model.
 
     Attributes:
-        filename (str): The name of the file containing grid world definitions.
-        grids (list): A list of parsed grid worlds.
-        current_grid (dict): The current grid world being used.
-        current_index (int): Index of the current grid world.
+        next_states (np.ndarray): Successor state indices, shape (S, A, K).
+        probs (np.ndarray): Probability of each successor, shape (S, A, K).
+        num_states (int): Number of states S.
+
+    Successor slots may repeat a state (e.g. a slip into a wall keeps the agent
+    in place); their probabilities add up, exactly like the dense model.
     """
 
-    def __init__(self, filename):
+    def __init__(self, next_states, probs, num_states):
         """
-        Initializes the GridWorldBuilder with the given filename.
-        
+        Initializes the sparse model from its successor and probability arrays.
+
         Args:
-            filename (str): The name of the file containing grid world definitions.
+            next_states (np.ndarray): Successor state indices, shape (S, A, K).
+            probs (np.ndarray): Probability of each successor, shape (S, A, K).
+            num_states (int): Number of states S.
         """
-        self.filename = filename
-        self.grids = self._parse_file()
-        self.current_grid = None
-        self.current_index = -1
+        self.next_states = next_states
+        self.probs = probs
+        self.num_states = num_states
+
+    @property
+    def shape(self):
+        return (self.num_states, self.next_states.shape[1], self.num_states)
+
+    def __getitem__(self, index):
+        """
+        Returns P(s' | s, a) for a (s, a, s') index, as the dense tensor would.
+        """
+        s, a, s_next = index
+        return self.probs[s, a][self.next_states[s, a] == s_next].sum()
+
+    def expectation(self, values):
+        """
+        Computes the expected next-state value for every (s, a) pair.
+
+        Args:
+            values (np.ndarray): A value for each state.
+
+        Returns:
+            np.ndarray: sum over s' of P(s' | s, a) * values[s'], shape (S, A).
+        """
+        return np.sum(self.probs * values[self.next_states], axis=-1)
+
+    def predecessors(self):
+        """
+        Builds the predecessor index of the model in compressed sparse row form.
+
+        Returns:
+            tuple: indptr and indices such that indices[indptr[s]:indptr[s + 1]]
+            are the distinct states with a nonzero probability of reaching s.
+        """
+        next_states = self.next_states.reshape(self.num_states, -1)
+        probs = np.broadcast_to(self.probs, self.next_states.shape).reshape(self.num_states, -1)
+        sources = np.broadcast_to(np.arange(self.num_states)[:, None], next_states.shape)
+        reachable = probs > 0
+        pairs = np.unique(next_states[reachable].astype(np.int64) * self.num_states + sources[reachable])
+        targets, indices = np.divmod(pairs, self.num_states)
+        indptr = np.searchsorted(targets, np.arange(self.num_states + 1))
+        return indptr, indices
+
+    def todense(self):
+        """
+        Expands the model into a dense S x A x S tensor.
+
+        Returns:
+            np.ndarray: P(s' | s, a) indexed as [s, a, s'].
+        """
+        num_states, num_actions, width = self.next_states.shape
+        dense = np.zeros(self.shape)
+        s = np.broadcast_to(np.arange(num_states)[:, None, None], self.next_states.shape)
+        a = np.broadcast_to(np.arange(num_actions)[None, :, None], self.next_states.shape)
+        probs = np.broadcast_to(self.probs, self.next_states.shape)
+        for k in range(width):
+            np.add.at(dense, (s[..., k], a[..., k], self.next_states[..., k]), probs[..., k])
+        return dense
+
+
+class CompactStates:
+    """
+    Contiguous index over the states of a grid world that solvers have to store.
+
+    Walls are dropped, as no other state can move into one. The live
+    (non-terminal) states come first and the remaining terminal states after
+    them. Solvers keep their arrays in this index and scatter them back onto
+    the grid only for output.
+
+    Attributes:
+        states (np.ndarray): The grid state of every compact state.
+        index (np.ndarray): The compact state of every grid state, -1 for walls.
+        order (np.ndarray): The compact states in the order of their grid states.
+        num_states (int): The number of compact states.
+        num_live (int): The number of live states; compact states from num_live on are terminal.
+        terminal (np.ndarray): Mask of the terminal compact states.
+        transition (SparseTransition): The transition model over compact states.
+        reward (np.ndarray): The reward of every compact state.
+    """
+
+    def __init__(self, successors, reward_table, terminal, walls, dtype):
+        """
+        Builds the index and the compact model.
+
+        Args:
+            successors (callable): Returns the successor grid states and their probabilities,
+                shape (n, A, K), of the n grid states it is given, e.g. GridModel.successors.
+            reward_table (np.ndarray): The reward of every grid state.
+            terminal (np.ndarray): Mask of the terminal grid states.
+            walls (np.ndarray): Mask of the wall grid states.
+            dtype (np.dtype): The integer type of the indices.
+        """
+        live = np.flatnonzero(~terminal)
+        self.states = np.concatenate([live, np.flatnonzero(terminal & ~walls)]).astype(dtype)
+        self.num_states = len(self.states)
+        self.num_live = len(live)
+        self.index = np.full(len(terminal), -1, dtype=dtype)
+        self.index[self.states] = np.arange(self.num_states)
+        self.order = np.argsort(self.states).astype(dtype)
+        self.terminal = np.arange(self.num_states) >= self.num_live
+        next_states, probs = successors(self.states)
+        self.transition = SparseTransition(self.index[next_states], probs, self.num_states)
+        self.reward = reward_table[self.states]
+
+    def arrays(self):
+        """
+        Returns the arrays the index holds memory for; a broadcast probs array holds none.
+        """
+        arrays = [self.states, self.index, self.order, self.terminal, self.reward, self.transition.next_states]
+        if 0 not in self.transition.probs.strides:
+            arrays.append(self.transition.probs)
+        return arrays
+
+    def reaching(self):
+        """
+        Finds the compact states from which a terminal state can be reached.
+
+        A live state outside this set never terminates, so its value is its
+        step reward discounted forever, whatever the policy.
+
+        Returns:
+            np.ndarray: Mask of the compact states that can reach a terminal state.
+        """
+        next_states = self.transition.next_states.reshape(self.num_states, -1)
+        probs = np.broadcast_to(self.transition.probs, self.transition.next_states.shape).reshape(next_states.shape)
+        sources = np.broadcast_to(np.arange(self.num_states)[:, None], next_states.shape)
+        moves = probs > 0
+        terminal = np.flatnonzero(self.terminal)
+        # Search the reversed moves from a root (index num_states) that leads to every terminal state.
+        rows = np.concatenate([next_states[moves], np.full(len(terminal), self.num_states)])
+        cols = np.concatenate([sources[moves], terminal])
+        graph = csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(self.num_states + 1,) * 2)
+        reached = np.zeros(self.num_states + 1, dtype=bool)
+        reached[breadth_first_order(graph, self.num_states, return_predecessors=False)] = True
+        return reached[:-1]
+
+    def scatter(self, array, fill=0):
+        """
+        Spreads an array over compact states onto all grid states.
+
+        Args:
+            array (np.ndarray): One entry (or row) per compact state.
+            fill (optional): The entry of the walls. Default is 0.
+
+        Returns:
+            np.ndarray: One entry (or row) per grid state.
+        """
+        array = np.asarray(array)
+        full = np.full((len(self.index),) + array.shape[1:], fill, dtype=array.dtype)
+        full[self.states] = array
+        return full
+
+
+class GridBatch:
+    """
+    Several grid worlds padded to a common number of compact states and stacked.
+
+    Padding states have no successors but themselves, no probability mass
+    and zero reward, and are masked as terminal so solvers skip them.
+
+    Attributes:
+        num_grids (int): The number of stacked grid worlds G.
+        num_states (int): The padded number of states S.
+        num_actions (int): The number of actions A.
+        shapes (list): The (h, w) of every grid world.
+        sizes (np.ndarray): The number of compact states of every grid world.
+        compacts (list): The CompactStates of every grid world.
+        next_states (np.ndarray): Successor state indices, shape (G, S, A, K).
+        probs (np.ndarray): Probability of each successor, shape (G, S, A, K).
+        reward_table (np.ndarray): The reward of every state, shape (G, S).
+        terminal (np.ndarray): Mask of terminal and padding states, shape (G, S).
+    """
+
+    def __init__(self, grids, num_actions):
+        """
+        Stacks the models of the given grid worlds.
+
+        Args:
+            grids (list): (h, w, compact) for every grid world, with its CompactStates.
+            num_actions (int): The number of actions A.
+        """
+        self.num_grids = len(grids)
+        self.num_actions = num_actions
+        self.shapes = [(h, w) for h, w, _ in grids]
+        self.compacts = [compact for _, _, compact in grids]
+        self.sizes = np.array([compact.num_states for compact in self.compacts])
+        self.num_states = int(self.sizes.max())
+        width = max(compact.transition.next_states.shape[-1] for compact in self.compacts)
+        shape = (self.num_grids, self.num_states, num_actions, width)
+        index = np.result_type(*[compact.transition.next_states for compact in self.compacts])
+        dtype = np.result_type(*[compact.reward for compact in self.compacts])
+        self.next_states = np.broadcast_to(np.arange(self.num_states, dtype=index)[:, None, None], shape).copy()
+        self.probs = np.zeros(shape, dtype=dtype)
+        self.reward_table = np.zeros((self.num_grids, self.num_states), dtype=dtype)
+        self.terminal = np.ones((self.num_grids, self.num_states), dtype=bool)
+        for g, compact in enumerate(self.compacts):
+            n, k = compact.num_states, compact.transition.next_states.shape[-1]
+            self.next_states[g, :n, :, :k] = compact.transition.next_states
+            self.probs[g, :n, :, :k] = compact.transition.probs
+            self.reward_table[g, :n] = compact.reward
+            self.terminal[g, :n] = compact.terminal
+
+    def unpad(self, array):
+        """
+        Splits a stacked (G, S, ...) array into per-grid arrays over all cells of each grid world.
+
+        Args:
+            array (np.ndarray): The stacked array.
+
+        Returns:
+            list: One array per grid world, with zeros for the walls.
+        """
+        return [compact.scatter(array[g, :n]) for g, (compact, n) in enumerate(zip(self.compacts, self.sizes))]
+
+
+class GridModel:
+    """
+    Model of a single grid world: its map, move table, terminal mask, transition model and rewards.
+
+    Subclasses provide `current_grid`, the prepared definition of the grid world,
+    and `dtype`, the floating point type of rewards, probabilities and the
+    solvers' values. State indices use the smallest sufficient integer type.
+
+    Attributes:
+        ACTIONS (list): The (row, column) offset of each action: up, right, down, left.
+    """
+
+    ACTIONS = [(-1, 0), (0, 1), (1, 0), (0, -1)]
 
     def update_attribute(self):
         """
@@ -37,71 +292,126 @@ class GridWorldBuilder:
         self.num_states = self.h * self.w
         self.num_actions = 4
 
-    def _parse_file(self):
+    def compile(self, cache=None):
         """
-        Parses the file to extract grid world definitions.
-        
+        Builds the model of the grid world described by the current attributes.
+
+        Args:
+            cache (GridCache, optional): Cache to load the compiled arrays from, and to store them in
+                when they have to be built.
+        """
+        self._compact = None
+        key = f"{self.current_grid['hash']}.{self.dtype.name}"
+        arrays = None if cache is None else cache.load(key)
+        if arrays is not None:
+            self.map = arrays['map']
+            self.moves = arrays['moves']
+            self.terminal = arrays['terminal']
+            self.reward_table = arrays['reward_table']
+            return
+        self.map = np.full(self.h * self.w, self.r, dtype=self.dtype)
+        self.map[list(self.L)] = list(self.L.values())
+        self.move_table()
+        self.terminal_states()
+        self.reward_function()
+        if cache is not None:
+            reward = self.current_grid['reward']
+            cache.save(key, {
+                'map': self.map, 'moves': self.moves, 'terminal': self.terminal,
+                'reward_table': self.reward_table,
+                'L_positions': np.array([(x, y) for x, y, _ in reward], dtype=np.int64).reshape(-1, 2),
+                'L_values': np.array([value for _, _, value in reward])})
+
+    def move_table(self):
+        """
+        Generates the deterministic move table for the current grid world.
+
+        moves[s, a] is the cell reached from s with action a (see ACTIONS);
+        moves off the grid or into a wall leave the agent in s.
+        """
+        states = np.arange(self.num_states, dtype=index_dtype(self.num_states * self.num_actions))
+        rows, cols = states // self.w, states % self.w
+        moves = np.empty((self.num_states, self.num_actions), dtype=states.dtype)
+        for a, (dr, dc) in enumerate(self.ACTIONS):
+            new_r, new_c = rows + dr, cols + dc
+            inside = (new_r >= 0) & (new_r < self.h) & (new_c >= 0) & (new_c < self.w)
+            moves[:, a] = np.where(inside, new_r * self.w + new_c, states)
+        self.moves = np.where(self.map[moves] == 0, states[:, None], moves)
+
+    def terminal_states(self):
+        """
+        Generates the terminal mask for the current grid world.
+
+        Together with `moves` and `reward_table` this is the compiled step
+        table the agents use to simulate the environment with array lookups.
+        """
+        self.terminal = np.zeros(self.num_states, dtype=bool)
+        self.terminal[list(self.L)] = True
+
+    def slip_distribution(self):
+        """
+        Returns the action noise of the current grid world.
+
         Returns:
-            list: A list of dictionaries representing grid worlds.
+            tuple: The action offsets (intended, clockwise, counter-clockwise) and their probabilities.
         """
-        grids = []
-        with open(self.filename, 'r') as file:
-            content = file.read()
-            grid_blocks = content.split('\n\n')  
-            for block in grid_blocks:
-                if block.strip():
-                    grid = {}
-                    for line in block.split('\n'):
-                        line = line.strip()
-                        if line.startswith('#') or not line:
-                            continue
-                        key, value = line.split('=', 1)
-                        key = key.strip()
-                        value = value.strip()
-                        try:
-                            value = ast.literal_eval(value)
-                        except ValueError:
-                            pass
-                        grid[key] = value
-                    grid['reward']=grid['L']
-                    grid['L'] = {pos[0] + (grid['h']-pos[1]-1) * grid['w'] : pos[2] for pos in grid['L']}
-                    
-                    grids.append(grid)
-        return grids
-
-    def transition_model(self):
-        """
-        Generates the transition model for the current grid world.
-        """
-        transition_model = np.zeros((self.num_states, self.num_actions, self.num_states))
         left_right = round((1 - self.p) * 10) / 10 / 2
-        for r in range(self.h):
-            for c in range(self.w):
-                s = self.get_state_from_pos((r, c))
-                neighbor_s = np.zeros(self.num_actions)
-                
-                if self.map[s] == self.r and s not in self.L.items():
-                    for a in range(self.num_actions):
-                        new_r, new_c = r, c
-                        if a == 0:
-                            new_r = max(r - 1, 0)
-                        elif a == 1:
-                            new_c = min(c + 1, self.w - 1)
-                        elif a == 2:
-                            new_r = min(r + 1, self.h - 1)
-                        elif a == 3:
-                            new_c = max(c - 1, 0)
-                        if self.map[self.get_state_from_pos((new_r, new_c))] == 0:
-                            new_r, new_c = r, c
-                        s_prime = self.get_state_from_pos((new_r, new_c))
-                        neighbor_s[a] = s_prime
-                else:
-                    neighbor_s = np.ones(self.num_actions) * s
-                for a in range(self.num_actions):
-                    transition_model[s, a, int(neighbor_s[a])] += self.p
-                    transition_model[s, a, int(neighbor_s[(a + 1) % self.num_actions])] += left_right
-                    transition_model[s, a, int(neighbor_s[(a - 1) % self.num_actions])] += left_right
-        self.transition = transition_model
+        return np.array([0, 1, -1]), np.array([self.p, left_right, left_right], dtype=self.dtype)
+
+    def successors(self, states):
+        """
+        Looks up the successors of the given states in the move table.
+
+        Every (s, a) pair has at most three successors (the intended move and
+        the two slips). Only cells with the step reward move; every other
+        state stays in place.
+
+        Args:
+            states (np.ndarray): Grid states.
+
+        Returns:
+            tuple: The successor grid states and their probabilities (broadcast, holding no memory),
+            both of shape (len(states), A, K).
+        """
+        neighbor_s = np.where((self.map[states] == self.r)[:, None], self.moves[states], states[:, None])
+        offsets, slip_probs = self.slip_distribution()
+        slip_actions = (np.arange(self.num_actions)[:, None] + offsets) % self.num_actions
+        next_states = neighbor_s[:, slip_actions]
+        return next_states, np.broadcast_to(slip_probs, next_states.shape)
+
+    @property
+    def transition(self):
+        """
+        Transition model over all grid states, built from the move table on every access.
+
+        Solvers work on `compact.transition` instead, which leaves out the
+        walls. Use `dense_transition` for the dense S x A x S view.
+
+        Returns:
+            SparseTransition: The fixed-width successor-index and probability arrays.
+        """
+        next_states, probs = self.successors(np.arange(self.num_states, dtype=self.moves.dtype))
+        return SparseTransition(next_states, probs, self.num_states)
+
+    @property
+    def compact(self):
+        """
+        The CompactStates of the current grid world, built on first use.
+        """
+        if self._compact is None:
+            self._compact = CompactStates(self.successors, self.reward_table, self.terminal, self.map == 0,
+                                          self.moves.dtype)
+        return self._compact
+
+    @property
+    def dense_transition(self):
+        """
+        Dense S x A x S view of the current transition model.
+
+        Returns:
+            np.ndarray: P(s' | s, a) indexed as [s, a, s'].
+        """
+        return self.transition.todense()
 
     def get_state_from_pos(self, pos):
         """
@@ -131,34 +441,53 @@ class GridWorldBuilder:
         """
         Generates the reward function for the current grid world.
         """
-        self.reward_table = np.zeros(self.num_states)
-        for r in range(self.h):
-            for c in range(self.w):
-                s = self.get_state_from_pos((r, c))
-                self.reward_table[s] = self.map[s]
-          
-    def __iter__(self):
-        return self
+        self.reward_table = self.map.astype(self.dtype)
 
-    def __next__(self):
-        self.current_index += 1
-        if self.current_index >= len(self.grids):
-            raise StopIteration
-        self.current_grid = self.grids[self.current_index]
-        self.update_attribute()
-        self.map = np.full(self.h * self.w, self.r)
-        for state, reward in self.L.items():
-            self.map[state] = reward
-        self.transition_model()
-        self.reward_function()
-        return self.w, self.h, self.L, self.p, self.r
 
-    def __prev__(self):
-        self.update_attribute()
-        pass
-    
+    def coarsen(self, factor=2, discount_factor=1):
+        """
+        Aggregates factor x factor blocks of the current grid world into a coarser definition.
+
+        Cells beyond the edge, and live cells from which no terminal can be
+        reached, count as walls, so the coarse grid opens no passage into a
+        region the fine grid keeps shut. A block is a wall when all of its cells
+        are walls. It is a terminal when all of its other cells are terminal, or
+        when it holds a goal (a positive terminal reward) that would otherwise be
+        lost, and carries the largest of its terminal rewards, so a goal is never
+        replaced by a pit. Every other block is live. One coarse step stands for
+        factor fine steps, so the step reward is accumulated over them with the
+        given discount.
+
+        Args:
+            factor (int, optional): The block size. Default is 2.
+            discount_factor (float, optional): The discount used to accumulate the step reward. Default is 1.
+
+        Returns:
+            dict: The coarse grid world definition, with w, h, L, p and r keys.
+        """
+        h, w = -(-self.h // factor), -(-self.w // factor)
+
+        def blocks(array, fill):
+            array = np.pad(array.reshape(self.h, self.w), ((0, h * factor - self.h), (0, w * factor - self.w)),
+                           constant_values=fill)
+            return array.reshape(h, factor, w, factor).swapaxes(1, 2).reshape(h, w, -1)
+
+        compact = self.compact
+        walls = blocks(compact.scatter(~compact.reaching() & ~compact.terminal, True), True)
+        terminal = blocks(self.terminal & (self.map != 0), False)
+        wall = walls.all(axis=-1)
+        values = blocks(self.map, 0)
+        best = np.argmax(np.where(terminal, values, -np.inf), axis=-1)
+        reward = np.take_along_axis(values, best[..., None], axis=-1)[..., 0]
+        absorbing = ~wall & ((walls | terminal).all(axis=-1) | (terminal.any(axis=-1) & (reward > 0)))
+        L = [(c.item(), h - 1 - r.item(), 0) for r, c in zip(*np.nonzero(wall))]
+        L += [(c.item(), h - 1 - r.item(), reward[r, c].item()) for r, c in zip(*np.nonzero(absorbing))]
+        return {'w': w, 'h': h, 'L': L, 'p': self.p, 'r': self.r * sum(discount_factor ** i for i in range(factor))}
 
     def visualize_value_policy(self, policy, values, plot,delta_history,discount_factor,fig_size=(8, 6)):
+        import matplotlib.pyplot as plt
+        import matplotlib.patches as patches
+
         unit = min(fig_size[1] // self.h, fig_size[0] // self.w)
         unit = max(1, unit)
         fig, ax = plt.subplots(1, 1, figsize=fig_size)
@@ -221,12 +550,485 @@ class GridWorldBuilder:
             plt.tight_layout()
             plt.show()
 
+    def render_value_policy(self, policy, values, filename=None, delta_history=None, discount_factor=None,
+                            fig_size=(8, 6), dpi=100, max_pixels=1024, max_arrows=48):
+        """
+        Draws the values as one image and the policy as one batch of arrows.
+
+        Unlike visualize_value_policy, the cost does not grow with one artist per
+        cell: grids larger than max_pixels cells on a side are averaged into
+        blocks, and arrows are drawn for at most max_arrows cells on a side,
+        sampled evenly. With a filename, the figure is written without a display
+        (PNG, SVG or any format matplotlib infers from the extension), so it
+        works in unattended runs. matplotlib is only imported here.
+
+        Args:
+            policy (np.ndarray): The action of every state (see ACTIONS), or None.
+            values (np.ndarray): The value of every state.
+            filename (str, optional): The file to write. Default is to show the figure.
+            delta_history (list, optional): Deltas per iteration, plotted next to the grid when given.
+            discount_factor (float, optional): The discount factor, used as the label of delta_history.
+            fig_size (tuple, optional): The figure size in inches. Default is (8, 6).
+            dpi (int, optional): The resolution of raster output. Default is 100.
+            max_pixels (int, optional): The largest number of image cells on a side. Default is 1024.
+            max_arrows (int, optional): The largest number of arrows on a side. Default is 48.
+        """
+        if filename is None:
+            import matplotlib.pyplot as plt
+            fig = plt.figure(figsize=fig_size)
+        else:
+            from matplotlib.figure import Figure
+            fig = Figure(figsize=fig_size)
+        if delta_history is None:
+            ax = fig.add_subplot(1, 1, 1)
+        else:
+            ax, delta_ax = fig.subplots(1, 2, gridspec_kw={'width_ratios': [3, 1]})
+
+        wall = (self.map == 0).reshape(self.h, self.w)
+        factor = -(-max(self.h, self.w) // max_pixels)
+        h, w = -(-self.h // factor), -(-self.w // factor)
+
+        def blocks(array):
+            array = np.pad(array, ((0, h * factor - self.h), (0, w * factor - self.w)))
+            return array.reshape(h, factor, w, factor).sum(axis=(1, 3))
+
+        counts = blocks(~wall)
+        image = np.ma.masked_array(blocks(np.where(wall, 0, np.asarray(values, dtype=float).reshape(self.h, self.w)))
+                                   / np.maximum(counts, 1), mask=counts == 0)
+        import matplotlib
+        cmap = (matplotlib.colormaps['viridis'] if hasattr(matplotlib, 'colormaps')
+                else matplotlib.cm.get_cmap('viridis')).copy()
+        cmap.set_bad('black')
+        extent = (0, w * factor, 0, h * factor)
+        shown = ax.imshow(image, cmap=cmap, interpolation='nearest', extent=extent)
+        fig.colorbar(shown, ax=ax, fraction=0.046, pad=0.04)
+
+        terminal = (self.terminal & (self.map != 0)).reshape(self.h, self.w)
+        goals = blocks(terminal & (self.map.reshape(self.h, self.w) > 0)) > 0
+        pits = blocks(terminal & (self.map.reshape(self.h, self.w) < 0)) > 0
+        overlay = np.zeros((h, w, 4))
+        overlay[goals] = (0, 0.5, 0, 0.8)
+        overlay[pits & ~goals] = (0.8, 0, 0, 0.8)
+        ax.imshow(overlay, interpolation='nearest', extent=extent)
+
+        if policy is not None:
+            stride = -(-max(self.h, self.w) // max_arrows)
+            rows, cols = np.mgrid[stride // 2:self.h:stride, stride // 2:self.w:stride]
+            rows, cols = rows.ravel(), cols.ravel()
+            states = rows * self.w + cols
+            live = (self.map[states] != 0) & ~self.terminal[states]
+            rows, cols, states = rows[live], cols[live], states[live]
+            offsets = np.array(self.ACTIONS)[np.asarray(policy).ravel()[states]]
+            ax.quiver(cols + 0.5, self.h - rows - 0.5, offsets[:, 1], -offsets[:, 0], color='white',
+                      pivot='middle', angles='xy', scale_units='xy', scale=1 / (0.6 * stride), width=0.004)
+        ax.set_xlim(0, self.w)
+        ax.set_ylim(0, self.h)
+        ax.set_xticks([])
+        ax.set_yticks([])
+
+        if delta_history is not None:
+            delta_ax.plot(np.arange(len(delta_history)) + 1, delta_history, marker='o', markersize=3,
+                          alpha=0.7, color='#2ca02c',
+                          label=None if discount_factor is None else r'$\gamma= $' + f'{discount_factor}')
+            delta_ax.set_yscale('log')
+            delta_ax.set_xlabel('Iteration')
+            delta_ax.set_ylabel('Delta')
+            if discount_factor is not None:
+                delta_ax.legend()
+        fig.tight_layout()
+        if filename is None:
+            import matplotlib.pyplot as plt
+            plt.show()
+        else:
+            fig.savefig(filename, dpi=dpi)
+
+
+class Grid(GridModel):
+    """
+    Immutable, independently held grid world, as returned by GridWorldBuilder[key].
+
+    Exposes the same attributes as GridWorldBuilder after loading a grid world,
+    so every solver accepts either. Attributes cannot be reassigned and the
+    arrays, including those of the compact state index built with the grid
+    world, are read-only.
+
+    Attributes:
+        name (str): The name of the grid world, or None.
+        current_grid (Mapping): The definition of the grid world.
+    """
+
+    def __init__(self, definition, cache=None, dtype=np.float64):
+        """
+        Builds the grid world.
+
+        Args:
+            definition (dict): A prepared grid world definition, as in GridWorldBuilder.grids.
+            cache (GridCache, optional): Cache of compiled grid worlds.
+            dtype (optional): The floating point type of the model and the solvers. Default is float64.
+        """
+        self.name = definition.get('name')
+        self.dtype = np.dtype(dtype)
+        self.current_grid = MappingProxyType(dict(definition, L=MappingProxyType(dict(definition['L']))))
+        self.update_attribute()
+        self.compile(cache)
+        compact = self.compact
+        for array in (self.map, self.moves, self.terminal, self.reward_table, *compact.arrays()):
+            array.flags.writeable = False
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError(f"Grid is immutable, cannot set {name!r}")
+        super().__setattr__(name, value)
+
+    @property
+    def nbytes(self):
+        """
+        The memory held by the arrays of the grid world and its compact state index, in bytes.
+        """
+        return sum(array.nbytes for array in (self.map, self.moves, self.terminal, self.reward_table,
+                                              *self._compact.arrays()))
+
+
+class DefinitionFile:
+    """
+    Lazily parsed grid world definitions file, as GridWorldBuilder.grids.
+
+    Opening the file only indexes it: for every definition it records the
+    byte offset and size of its block, its name, its content hash and the
+    short values (w, h, p, r). The L list, by far the largest part of a big
+    map, is parsed when the definition is accessed. When a GridCache already
+    holds the compiled grid world, L is read from the cache entry instead
+    and the file is not touched at all. Definitions are rebuilt on every
+    access and not kept.
+
+    Attributes:
+        filename (str): The definitions file.
+        blocks (list): One dictionary per definition with its offset, size, name, hash and short values.
+        cache (GridCache): Cache of compiled grid worlds, or None.
+        dtype (np.dtype): The floating point type of the cache entries looked up.
+    """
+
+    def __init__(self, filename, cache=None, dtype=np.float64, blocks=None):
+        """
+        Indexes the file.
+
+        Args:
+            filename (str): The definitions file.
+            cache (GridCache, optional): Cache of compiled grid worlds to read L from.
+            dtype (optional): The floating point type of the cache entries looked up. Default is float64.
+            blocks (list, optional): Blocks of an earlier index of the same file, e.g. one job's block
+                sent to a worker process. Default is to index the whole file.
+        """
+        self.filename = filename
+        self.cache = cache
+        self.dtype = np.dtype(dtype)
+        self.blocks = self._index() if blocks is None else list(blocks)
+
+    def _index(self):
+        """
+        Reads the file once, hashing every block without parsing its L list.
+
+        The hash covers the stripped non-comment lines of a block joined by newlines,
+        and a block is named by the first word of its last comment line.
+
+        Returns:
+            list: The blocks.
+        """
+        blocks = []
+        with open(self.filename, 'rb') as file:
+            block, digest, offset = {}, None, 0
+            for line in itertools.chain(file, [b'']):
+                start, offset = offset, offset + len(line)
+                if line.strip(b'\r\n'):
+                    line = line.strip()
+                    if line.startswith(b'#') and line[1:].split():
+                        block['name'] = line[1:].split()[0].decode()
+                    if line.startswith(b'#') or not line:
+                        continue
+                    if digest is None:
+                        digest = hashlib.sha256(line)
+                        block['offset'] = start
+                    else:
+                        digest.update(b'\n' + line)
+                    key, value = line.split(b'=', 1)
+                    key = key.strip().decode()
+                    if key != 'L':
+                        value = GridWorldBuilder._parse_value(key, value.strip().decode())
+                        block.setdefault('values', {})[key] = value
+                    block['size'] = offset - block['offset']
+                elif digest is not None:
+                    block.setdefault('name', None)
+                    block['hash'] = digest.hexdigest()
+                    blocks.append(block)
+                    block, digest = {}, None
+                else:
+                    block = {}
+        return blocks
+
+    @property
+    def names(self):
+        """
+        The name of every definition, None where it has none.
+        """
+        return [block['name'] for block in self.blocks]
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, index):
+        """
+        Builds the prepared definition of a block.
+
+        Args:
+            index (int): The index of the definition.
+
+        Returns:
+            dict: The definition, prepared as by GridWorldBuilder.
+        """
+        block = self.blocks[index]
+        grid = dict(block.get('values', {}), name=block['name'])
+        arrays = None if self.cache is None else self.cache.load(f"{block['hash']}.{self.dtype.name}")
+        if arrays is not None:
+            positions, values = np.asarray(arrays['L_positions']), arrays['L_values'].tolist()
+            grid['L'] = list(zip(positions[:, 0].tolist(), positions[:, 1].tolist(), values))
+            states = positions[:, 0] + (grid['h'] - positions[:, 1] - 1) * grid['w']
+            return GridWorldBuilder._prepare(grid, block['hash'], dict(zip(states.tolist(), values)))
+        with open(self.filename, 'rb') as file:
+            file.seek(block['offset'])
+            text = file.read(block['size']).decode()
+        for line in text.splitlines():
+            key, _, value = line.strip().partition('=')
+            if key.strip() == 'L':
+                grid['L'] = GridWorldBuilder._parse_value('L', value.strip())
+        return GridWorldBuilder._prepare(grid, digest=block['hash'])
+
+
+class GridWorldBuilder(GridModel):
+    """
+    Class for building and managing grid worlds for reinforcement learning tasks.
+
+    Attributes:
+        filename (str): The name of the file containing grid world definitions.
+        grids (Sequence): The grid world definitions: a DefinitionFile, which parses a definition
+            only when it is accessed, or the list of definitions given directly.
+        names (list): The name of every grid world, None where it has none.
+        current_grid (dict): The current grid world being used.
+        current_index (int): Index of the current grid world.
+
+    Grid worlds can also be accessed by index or name, e.g. builder["t4"], as
+    independent immutable Grid objects that are built on first access and kept
+    in a least-recently-used cache.
+    """
+
+    def __init__(self, filename=None, grids=None, cache_dir=None, max_cache_bytes=512 * 2**20, dtype=np.float64):
+        """
+        Initializes the GridWorldBuilder with the given filename.
+        
+        Args:
+            filename (str): The name of the file containing grid world definitions.
+            grids (list, optional): Grid world definitions given directly instead of a file,
+                as dictionaries with the same w, h, L, p and r keys.
+            cache_dir (str, optional): Directory of a GridCache holding compiled grid worlds.
+            max_cache_bytes (int): Memory budget of the Grid objects kept for builder[key]. The most
+                recently accessed grid world is always kept.
+            dtype (optional): The floating point type of rewards, probabilities and the values of the
+                solvers. float32 halves their memory and bandwidth. Default is float64.
+        """
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.cache = None if cache_dir is None else GridCache(cache_dir)
+        if grids is None:
+            self.grids = DefinitionFile(filename, self.cache, self.dtype)
+            self.names = self.grids.names
+        else:
+            self.grids = [self._prepare(dict(grid)) for grid in grids]
+            self.names = [grid['name'] for grid in self.grids]
+        self.current_grid = None
+        self.current_index = -1
+        self.max_cache_bytes = max_cache_bytes
+        self._built = OrderedDict()
+        self._built_bytes = 0
+
+    @staticmethod
+    def _parse_value(key, value):
+        """
+        Parses the value of one line of a grid world definition.
+
+        Args:
+            key (str): The name of the value.
+            value (str): The value text.
+
+        Returns:
+            The parsed value, or the text itself when it is not a Python literal.
+        """
+        if key == 'L':
+            numbers = value.translate(str.maketrans('[](),', '     ')).split()
+            try:
+                table = np.array(numbers, dtype=float).reshape(-1, 3)
+            except ValueError:
+                table = None
+            if table is not None:
+                values = table[:, 2]
+                values = values.astype(int) if np.all(values == np.round(values)) else values
+                return list(zip(table[:, 0].astype(int).tolist(), table[:, 1].astype(int).tolist(),
+                                values.tolist()))
+        try:
+            return ast.literal_eval(value)
+        except ValueError:
+            return value
+
+    @staticmethod
+    def _prepare(grid, digest=None, states=None):
+        """
+        Converts the L list of a grid world definition into a state-indexed dictionary.
+
+        The original (x, y, value) list is kept under 'reward', and the content
+        hash of the definition under 'hash'. A grid world is named by the first
+        word of the last comment line before it, e.g. "#t4 the cliff" names t4.
+
+        Args:
+            grid (dict): A grid world definition.
+            digest (str, optional): The content hash of the definition text, without comments.
+                Default is the hash of the parsed values.
+            states (dict, optional): The state-indexed dictionary, when it is already known.
+
+        Returns:
+            dict: The prepared grid world.
+        """
+        if digest is None:
+            source = repr([(key, grid[key]) for key in ('w', 'h', 'L', 'p', 'r')])
+            digest = hashlib.sha256(source.encode()).hexdigest()
+        grid.setdefault('name', None)
+        grid['hash'] = digest
+        grid['reward']=grid['L']
+        if states is None:
+            states = {pos[0] + (grid['h']-pos[1]-1) * grid['w'] : pos[2] for pos in grid['L']}
+        grid['L'] = states
+        return grid
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.current_index + 1 >= len(self.grids):
+            raise StopIteration
+        self.load(self.current_index + 1)
+        return self.w, self.h, self.L, self.p, self.r
+
+    def load(self, index):
+        """
+        Makes the grid world at the given index the current one and builds its model.
+
+        Args:
+            index (int): Index of the grid world in self.grids.
+        """
+        self.current_index = index
+        self.current_grid = self.grids[index]
+        self.update_attribute()
+        self.compile(self.cache)
+
+    def reparameterize(self, p=None, r=None):
+        """
+        Changes the slip probability and/or step reward of the current grid world.
+
+        The move table only depends on the walls, so it is reused unless the new
+        step reward turns cells into walls or back. The definition in self.grids
+        is left unchanged.
+
+        Args:
+            p (float, optional): The new probability of moving as intended.
+            r (float, optional): The new step reward.
+        """
+        walls = self.map == 0
+        self._compact = None
+        self.p = self.p if p is None else p
+        self.r = self.r if r is None else r
+        self.map = np.full(self.h * self.w, self.r, dtype=self.dtype)
+        self.map[list(self.L)] = list(self.L.values())
+        if not np.array_equal(self.map == 0, walls):
+            self.move_table()
+        self.reward_function()
+
+    def batch(self, indices=None):
+        """
+        Builds several grid worlds and stacks them into one padded GridBatch.
+
+        The current grid world is left unchanged.
+
+        Args:
+            indices (list, optional): Indices of the grid worlds to stack. Default is all of them.
+
+        Returns:
+            GridBatch: The stacked grid worlds.
+        """
+        current_index = self.current_index
+        grids = []
+        for index in range(len(self.grids)) if indices is None else indices:
+            self.load(index)
+            grids.append((self.h, self.w, self.compact))
+        if current_index >= 0:
+            self.load(current_index)
+        else:
+            self.current_index = current_index
+        return GridBatch(grids, self.num_actions)
+
+    def __len__(self):
+        return len(self.grids)
+
+    def index(self, key):
+        """
+        Resolves a grid world key to its index in self.grids.
+
+        Args:
+            key (int | str): The index (negative counts from the end) or the name of the grid world.
+
+        Returns:
+            int: The index of the grid world.
+        """
+        if isinstance(key, str):
+            if key in self.names:
+                return self.names.index(key)
+            raise KeyError(f"No grid world named {key!r}")
+        if not -len(self.grids) <= key < len(self.grids):
+            raise IndexError(f"Grid world index {key} out of range for {len(self.grids)} grid worlds")
+        return key % len(self.grids)
+
+    def __getitem__(self, key):
+        """
+        Returns a grid world as an immutable Grid, building it on first access.
+
+        Built grid worlds are kept in a least-recently-used cache of at most
+        max_cache_bytes. The current grid world of the builder is left unchanged.
+
+        Args:
+            key (int | str): The index or the name of the grid world.
+
+        Returns:
+            Grid: The grid world.
+        """
+        index = self.index(key)
+        grid = self._built.pop(index, None)
+        if grid is None:
+            grid = Grid(self.grids[index], self.cache, self.dtype)
+            self._built_bytes += grid.nbytes
+        self._built[index] = grid
+        while len(self._built) > 1 and self._built_bytes > self.max_cache_bytes:
+            self._built_bytes -= self._built.popitem(last=False)[1].nbytes
+        return grid
+
+    def __prev__(self):
+        self.update_attribute()
+        pass
+    
+
 if __name__ == "__main__":
     g = GridWorldBuilder("GridWorld.py")
     for _ in g:
+        transition = g.transition
         for current_s in range(g.num_states):
             for next_s in range(g.num_states):
                 for action in range(g.num_actions):
-                    print(f'P(s\' = {next_s}| s = {current_s} ,a = {action} ) = {g.transition[current_s, action,next_s ]}')
+                    print(f'P(s\' = {next_s}| s = {current_s} ,a = {action} ) = {transition[current_s, action,next_s ]}')
         print(g.reward_table)
         input()
@@ -1,15 +1,23 @@
 import numpy as np
-from GridWorldBuilder import GridWorldBuilder
+from GridWorldBuilder import GridWorldBuilder, SparseTransition
+from ReplayBuffer import ReplayBuffer
+from ActionSelector import ActionSelector
 import random
+import time
+from Metrics import peak_memory
 
 random.seed(42)
 
 class ModelBasedRL:
     """
     Model-Based Reinforcement Learning (MBRL) agent for solving grid world problems.
+
+    As ModelFreeRL, the agent works over the compact state index of the grid
+    world, which leaves out the walls; value_iteration and
+    iterative_policy_learning scatter their results back onto the grid.
     """
     
-    def __init__(self, grid: GridWorldBuilder, discount_factor=0.5, epsilon=0.01, decay=0.99, learning_rate=0.01, episodes=1000) -> None:
+    def __init__(self, grid: GridWorldBuilder, discount_factor=0.5, epsilon=0.01, decay=0.99, learning_rate=0.01, episodes=1000, replay: ReplayBuffer = None, seed=None, metrics=None) -> None:
         """
         Initialize the MBRL agent with given parameters.
 
@@ -20,6 +28,9 @@ class ModelBasedRL:
             decay (float): The decay rate for epsilon.
             learning_rate (float): The learning rate for Q-learning updates.
             episodes (int): The number of training episodes.
+            replay (ReplayBuffer): Optional buffer that retains the raw transitions.
+            seed (int): Seed for private random streams. By default they are seeded from the global random module.
+            metrics (callable): Called as metrics(event, fields) once per episode, e.g. a sink from Metrics.
         """
         self.grid = grid
         self.discount_factor = discount_factor
@@ -29,8 +40,28 @@ class ModelBasedRL:
         self.episodes = episodes
         self.rewards = self._initialize_rewards()
         self.actions = [(1, 0), (0, -1), (-1, 0), (0, 1)]
-        self.q_values = np.zeros((self.grid.num_states, self.grid.num_actions))
+        self.compact = self.grid.compact
+        self.num_states = self.compact.num_states
+        self.q_values = np.zeros((self.num_states, self.grid.num_actions), dtype=self.grid.dtype)
         self.reward_grid = self._create_reward_grid()
+        self.reward_vector = self.reward_grid.ravel()[self.compact.states]
+        moves = self.grid.moves[self.compact.states]
+        self.step_table = self.compact.index[moves[:, [GridWorldBuilder.ACTIONS.index(a) for a in self.actions]]]
+        self.start_excluded = self.compact.terminal
+        self.replay = replay
+        self.metrics = metrics
+        self.random = random if seed is None else random.Random(seed)
+        self.np_random = np.random.default_rng(self.random.getrandbits(64) if seed is None else seed)
+        self.selector = ActionSelector(self.grid.num_actions, self.np_random)
+        # Running model statistics. A single step can only reach the state
+        # itself or one of its neighbours, so next-state counts are kept per
+        # candidate successor slot instead of over the whole state space.
+        # Counts use the index type as well, as no pair is visited 2**31 times.
+        index = self.step_table.dtype
+        self.successors = np.column_stack([np.arange(self.num_states, dtype=index), self.step_table])
+        self.visits = np.zeros((self.num_states, self.grid.num_actions), dtype=index)
+        self.reward_sums = np.zeros((self.num_states, self.grid.num_actions), dtype=self.grid.dtype)
+        self.successor_counts = np.zeros(self.visits.shape + self.successors.shape[1:], dtype=index)
 
     def _initialize_rewards(self):
         """
@@ -59,16 +90,13 @@ class ModelBasedRL:
         Boltzmann exploration policy to select an action.
 
         Args:
-            state (int): The current state index.
+            state (int | np.ndarray): The current state index, or several of them.
             temperature (float): The temperature parameter for Boltzmann exploration.
 
         Returns:
-            int: The selected action.
+            int | np.ndarray: The selected action, or one action per state.
         """
-        q_values = self.q_values[state]
-        exp_q = np.exp(np.array(q_values) / temperature)
-        probs = exp_q / np.sum(exp_q)
-        return np.random.choice(range(self.grid.num_actions), p=probs)
+        return self.selector.softmax(self.q_values[state], temperature)
 
     def get_next_state(self, state, action):
         """
@@ -81,13 +109,7 @@ class ModelBasedRL:
         Returns:
             int: The next state index.
         """
-        r, c = self.grid.get_pos_from_state(state)
-        dr, dc = self.actions[action]
-        new_r, new_c = r + dr, c + dc
-        if new_r < 0 or new_c < 0 or new_r >= self.grid.h or new_c >= self.grid.w or ((new_r, new_c) in [(py, px) for px, py, val in self.rewards if val == 0]):
-            return state
-        else:
-            return self.grid.get_state_from_pos((new_r, new_c))
+        return self.step_table[state, action]
 
     def calculate_expected_utility(self, state, action):
         """
@@ -104,8 +126,8 @@ class ModelBasedRL:
         for delta_action in [-1, 0, 1]:
             new_action = (action + delta_action) % self.grid.num_actions
             prob = self.grid.p if delta_action == 0 else (1 - self.grid.p) / 2
-            next_state = self.get_next_state(state, new_action)
-            expected_utility += prob * (self.reward_grid[self.grid.get_pos_from_state(next_state)] + self.discount_factor * np.max(self.q_values[next_state]))
+            next_state = self.step_table[state, new_action]
+            expected_utility += prob * (self.reward_vector[next_state] + self.discount_factor * np.max(self.q_values[next_state]))
         return expected_utility
 
     def learn_mdp_from_experience(self, experience):
@@ -113,58 +135,94 @@ class ModelBasedRL:
         Learn the MDP model from experience.
 
         Args:
-            experience (list): The list of experiences.
+            experience (list | ReplayBuffer): The experiences, as (state, action, reward, next_state) tuples.
 
         Returns:
             tuple: The transition and reward matrices.
         """
-        T = np.zeros((self.grid.h, self.grid.w, self.grid.num_actions, self.grid.h, self.grid.w))
-        R = np.zeros((self.grid.h, self.grid.w, self.grid.num_actions))
-        N = np.zeros((self.grid.h, self.grid.w, self.grid.num_actions))
-        
-        for (i, a, r, j) in experience:
-            i_r, i_c = self.grid.get_pos_from_state(i)
-            j_r, j_c = self.grid.get_pos_from_state(j)
-            T[i_r, i_c, a, j_r, j_c] += 1
-            R[i_r, i_c, a] += r
-            N[i_r, i_c, a] += 1
+        if isinstance(experience, ReplayBuffer):
+            n = len(experience)
+            states, actions = experience.states[:n], experience.actions[:n]
+            rewards, next_states = experience.rewards[:n], experience.next_states[:n]
+        else:
+            states, actions, rewards, next_states = (np.array(column) for column in zip(*experience))
+        slots = np.argmax(self.successors[states] == next_states[:, None], axis=1)
+        visits = np.zeros_like(self.visits)
+        reward_sums = np.zeros_like(self.reward_sums)
+        successor_counts = np.zeros_like(self.successor_counts)
+        np.add.at(visits, (states, actions), 1)
+        np.add.at(reward_sums, (states, actions), rewards)
+        np.add.at(successor_counts, (states, actions, slots), 1)
+        return self._estimate(visits, reward_sums, successor_counts)
+
+    def observe(self, state, action, reward, next_state):
+        """
+        Update the running model statistics with one transition in O(1).
 
-        for r in range(self.grid.h):
-            for c in range(self.grid.w):
-                for a in range(self.grid.num_actions):
-                    if N[r, c, a] > 0:
-                        R[r, c, a] /= N[r, c, a]
-                        T[r, c, a] /= N[r, c, a]
-                        
-        return T, R
+        Args:
+            state (int): The state the transition starts from.
+            action (int): The action taken.
+            reward (float): The reward received.
+            next_state (int): The state reached.
+        """
+        slot = np.argmax(self.successors[state] == next_state)
+        self.visits[state, action] += 1
+        self.reward_sums[state, action] += reward
+        self.successor_counts[state, action, slot] += 1
+        if self.replay is not None:
+            self.replay.add(state, action, reward, next_state)
+
+    def model(self):
+        """
+        Build the maximum-likelihood MDP from the running model statistics.
 
-    def value_iteration(self, T, R, threshold=0.01):
+        Returns:
+            tuple: The transition and reward matrices, as returned by learn_mdp_from_experience.
+        """
+        return self._estimate(self.visits, self.reward_sums, self.successor_counts)
+
+    def _estimate(self, visits, reward_sums, successor_counts):
+        """
+        Normalize transition statistics into a sparse transition model and mean rewards.
+
+        Unvisited (state, action) pairs get no successors and a zero reward.
+        """
+        visits = np.maximum(visits, 1)
+        next_states = np.broadcast_to(self.successors[:, None, :], successor_counts.shape)
+        probs = (successor_counts / visits[:, :, None]).astype(self.grid.dtype)
+        T = SparseTransition(next_states, probs, self.num_states)
+        return T, (reward_sums / visits).astype(self.grid.dtype)
+
+    def value_iteration(self, T, R, threshold=0.01, V=None):
         """
         Perform value iteration to solve the MDP.
 
+        All states are backed up at once on the flattened state space, and the
+        policy is the greedy action of the final sweep.
+
         Args:
-            T (np.ndarray): The transition matrix.
-            R (np.ndarray): The reward matrix.
+            T (SparseTransition): The transition model.
+            R (np.ndarray): The reward matrix, shape (num_states, num_actions).
             threshold (float): The threshold for convergence.
+            V (np.ndarray): Optional initial values shaped like the grid, e.g. the solution of the previous model.
 
         Returns:
-            tuple: The optimal policy and value function.
+            tuple: The optimal policy and value function, each shaped like the grid; 0 in walls.
         """
-        V = np.zeros((self.grid.h, self.grid.w))
-        policy = np.zeros((self.grid.h, self.grid.w), dtype=int)
+        dtype = self.grid.dtype
+        if V is None:
+            V = np.zeros(self.num_states, dtype=dtype)
+        else:
+            V = np.array(V, dtype=dtype).ravel()[self.compact.states]
         while True:
-            delta = 0
-            for r in range(self.grid.h):
-                for c in range(self.grid.w):
-                    v = V[r, c]
-                    V[r, c] = max(sum(T[r, c, a, r2, c2] * (R[r, c, a] + self.discount_factor * V[r2, c2])
-                                    for r2 in range(self.grid.h) for c2 in range(self.grid.w)) for a in range(self.grid.num_actions))
-                    policy[r, c] = np.argmax([sum(T[r, c, a, r2, c2] * (R[r, c, a] + self.discount_factor * V[r2, c2])
-                                                for r2 in range(self.grid.h) for c2 in range(self.grid.w)) for a in range(self.grid.num_actions)])
-                    delta = max(delta, abs(v - V[r, c]))
+            Q = np.sum(T.probs * (R[:, :, None] + self.discount_factor * V[T.next_states]), axis=-1)
+            new_V = np.max(Q, axis=1)
+            delta = np.max(np.abs(new_V - V))
+            V = new_V
             if delta < threshold:
                 break
-        return policy, V
+        shape = (self.grid.h, self.grid.w)
+        return self.compact.scatter(np.argmax(Q, axis=1)).reshape(shape), self.compact.scatter(V).reshape(shape)
 
     def iterative_policy_learning(self):
         """
@@ -173,36 +231,46 @@ class ModelBasedRL:
         Returns:
             np.ndarray: The optimal policy.
         """
-        experience = []
         temperature = 1
         k = 0
+        V = None
 
         while True:
             k += 1
-            state = random.randint(0, self.grid.num_states - 1)
-            while self.grid.get_pos_from_state(state) in [(py, px) for px, py, val in self.rewards if val != 0]:
-                state = random.randint(0, self.grid.num_states - 1)
+            start = time.perf_counter()
+            episode_return = 0
+            state = self.random.randint(0, self.num_states - 1)
+            while self.start_excluded[state]:
+                state = self.random.randint(0, self.num_states - 1)
 
             for _ in range(10000):  # Choose a suitable number of steps for each episode
                 action = self.boltzmann_exploration(state, temperature)
-                next_state = self.get_next_state(state, action)
-                reward = self.reward_grid[self.grid.get_pos_from_state(next_state)]
-                experience.append((state, action, reward, next_state))
+                next_state = self.step_table[state, action]
+                reward = self.reward_vector[next_state]
+                self.observe(state, action, reward, next_state)
+                episode_return += reward
                 state = next_state
 
-            T, R_mdp = self.learn_mdp_from_experience(experience)
-            new_policy, _ = self.value_iteration(T, R_mdp, self.discount_factor)
+            T, R_mdp = self.model()
+            new_policy, V = self.value_iteration(T, R_mdp, self.discount_factor, V)
             policy_stable = True
+            delta = 0
 
-            # Update Q-values and check if the policy is stable
-            for r in range(self.grid.h):
-                for c in range(self.grid.w):
-                    for a in range(self.grid.num_actions):
-                        q_value = self.calculate_expected_utility(self.grid.get_state_from_pos((r, c)), a)
-                        if abs(self.q_values[self.grid.get_state_from_pos((r, c))][a] - q_value) > 0.01:
-                            policy_stable = False
-                        self.q_values[self.grid.get_state_from_pos((r, c))][a] = q_value
-
+            # Update Q-values in grid order and check if the policy is stable
+            for state in self.compact.order.tolist():
+                for a in range(self.grid.num_actions):
+                    q_value = self.calculate_expected_utility(state, a)
+                    change = abs(self.q_values[state][a] - q_value)
+                    delta = max(delta, change)
+                    if change > 0.01:
+                        policy_stable = False
+                    self.q_values[state][a] = q_value
+
+            if self.metrics is not None:
+                self.metrics('episode', {'solver': 'ModelBasedRL', 'episode': k - 1,
+                                         'seconds': time.perf_counter() - start, 'length': 10000,
+                                         'return': float(episode_return), 'temperature': temperature,
+                                         'delta': float(delta), 'memory': peak_memory()})
             if policy_stable:
                 break
             temperature *= self.decay
@@ -240,7 +308,7 @@ if __name__ == "__main__":
     for grid in grids:
         agent = ModelBasedRL(grids)
         policy = agent.iterative_policy_learning()
-        values = np.max(agent.q_values, axis=1).reshape(agent.grid.h, agent.grid.w)
+        values = agent.compact.scatter(np.max(agent.q_values, axis=1)).reshape(agent.grid.h, agent.grid.w)
         print("Values after training:\n")
         agent.print_environment(values)
         break
@@ -1,96 +1,609 @@
+import time
 import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import spsolve
 from GridWorldBuilder import *
-import matplotlib.pyplot as plt
+from Metrics import peak_memory
 
 class ValueIteration:
     """
     Class for performing value iteration on a Markov Decision Process.
 
+    The solver works on the compact states of the grid world (see
+    CompactStates), so walls are neither stored nor backed up. values and
+    policy are scattered back onto all grid states.
+
     Attributes:
-        reward_function (np.ndarray): The reward function for each state.
-        transition_model (np.ndarray): The transition model of the MDP.
+        compact (CompactStates): The state index the solver works in.
+        reward_function (np.ndarray): The reward function for each compact state.
+        transition_model (SparseTransition): The transition model over compact states.
         discount_factor (float): The discount factor for future rewards.
         theta (float): The threshold for stopping the iteration.
+        state_values (np.ndarray): The value of every compact state.
+        batch_size (int): The number of states a 'prioritized' step backs up.
     """
 
-    def __init__(self,grid:GridWorldBuilder, discount_factor=0.5, theta=0.01):
+    BACKUPS = ('gauss-seidel', 'sync', 'prioritized')
+    BATCH_FRACTION = 1 / 2
+
+    def __init__(self,grid:GridWorldBuilder, discount_factor=0.5, theta=0.01, backup='gauss-seidel', values=None,
+                 metrics=None, batch_size=None):
         """
         Initializes the ValueIteration class with the given parameters.
 
         Args:
             reward_function (np.ndarray): The reward function for each state.
-            transition_model (np.ndarray): The transition model of the MDP.
+            transition_model (SparseTransition): The transition model of the MDP.
             discount_factor (float, optional): The discount factor for future rewards. Default is 1.
             theta (float, optional): The threshold for stopping the iteration. Default is 0.01.
+            backup (str, optional): 'gauss-seidel' updates the values in place state by state,
+                'sync' backs up every state at once from the previous sweep's values,
+                'prioritized' backs up batches of the states with the largest Bellman errors.
+                Default is 'gauss-seidel'.
+            values (np.ndarray, optional): Initial values to warm-start from. Terminal states
+                are set to the values a cold start gives them. Default is zeros.
+            metrics (callable, optional): Called as metrics('iteration', fields) after every
+                iteration, e.g. a sink from Metrics. Default is None.
+            batch_size (int, optional): The number of states a 'prioritized' step backs up.
+                Default is BATCH_FRACTION of the states, at least 1.
         """
-        self.num_states = grid.num_states
+        if backup not in self.BACKUPS:
+            raise ValueError(f"Unknown backup mode {backup!r}, expected one of {self.BACKUPS}")
+        self.compact = grid.compact
+        self.num_states = self.compact.num_states
         self.num_actions = grid.num_actions
-        self.reward_function = grid.reward_table
-        self.transition_model = grid.transition
+        self.reward_function = self.compact.reward
+        self.transition_model = self.compact.transition
         self.discount_factor = discount_factor
-        self.values = np.zeros(self.num_states)
+        self.dtype = grid.dtype
+        self.state_values = np.zeros(self.num_states, dtype=self.dtype)
         self.policy = None
         self.grid =grid
         self.theta = theta
-    
+        self.backup = backup
+        self.terminal = self.compact.terminal
+        self.warm_start = values is not None
+        if self.warm_start:
+            values = np.asarray(values, dtype=self.dtype).ravel()[self.compact.states]
+            self.state_values = np.where(self.terminal, self.terminal_values(), values)
+        self.greedy = np.zeros(self.num_states, dtype=int)
+        self.backups = 0
+        self.metrics = metrics
+        self.batch_size = max(1, int(self.num_states * self.BATCH_FRACTION)) if batch_size is None else batch_size
+
+    @property
+    def values(self):
+        """
+        The value of every grid state; walls have value 0.
+        """
+        return self.compact.scatter(self.state_values)
+
+    def report(self, iteration, start, delta):
+        """
+        Sends the metrics of one iteration to self.metrics, if set.
+
+        Args:
+            iteration (int): The number of the iteration, from 0.
+            start (float): The time.perf_counter() value at the start of the iteration.
+            delta (float): The largest value change of the iteration.
+        """
+        if self.metrics is not None:
+            self.metrics('iteration', {'solver': type(self).__name__, 'states': self.num_states,
+                                       'iteration': iteration, 'seconds': time.perf_counter() - start,
+                                       'backups': int(self.backups), 'delta': float(delta), 'memory': peak_memory()})
+
+    def terminal_values(self):
+        """
+        Returns the fixed values of the terminal states, zero elsewhere.
+
+        These are the values the first sweep of a cold start gives them.
+        """
+        values = np.zeros(self.num_states, dtype=self.dtype)
+        values[self.terminal] = np.max(self.q_values(values), axis=1)[self.terminal]
+        return values
+
+    def q_values(self, values=None):
+        """
+        Computes Q(s, a) for every state and action in one pass.
+
+        Args:
+            values (np.ndarray, optional): The state values to back up from. Default is self.state_values.
+
+        Returns:
+            np.ndarray: The action values, shape (num_states, num_actions).
+        """
+        if values is None:
+            values = self.state_values
+        return np.sum(self.transition_model.probs
+                      * (self.reward_function[:, None, None]
+                         + self.discount_factor * values[self.transition_model.next_states]), axis=-1)
+
     def one_iteration(self,one=True):
         """
         Performs one iteration of value iteration.
 
+        In 'sync' mode the greedy action of every state is recorded in self.greedy during the same pass.
+
+        Args:
+            one (bool, optional): Whether to back up the terminal states in grid.L as well. Default is True.
+
         Returns:
             float: The maximum change in value during this iteration.
         """
+        if self.backup == 'sync':
+            return self._sync_iteration(one)
+        return self._gauss_seidel_iteration(one)
+
+    def state_q_values(self, s):
+        """
+        Computes Q(s, a) for every action of a single state, or of an array of states.
+
+        Args:
+            s (int | np.ndarray): The state or states.
+
+        Returns:
+            np.ndarray: The action values of s, shape (..., num_actions).
+        """
+        next_states = self.transition_model.next_states[s]
+        reward = np.asarray(self.reward_function[s])[..., None, None]
+        return np.sum(self.transition_model.probs[s]
+                      * (reward + self.discount_factor * self.state_values[next_states]), axis=-1)
+
+    def _sync_iteration(self, one):
+        self.backups += self.num_states if one else np.count_nonzero(~self.terminal)
+        q = self.q_values()
+        self.greedy = np.argmax(q, axis=1)
+        new_values = np.max(q, axis=1)
+        if not one:
+            new_values[self.terminal] = self.state_values[self.terminal]
+        delta = np.max(np.abs(new_values - self.state_values), initial=0)
+        self.state_values = new_values
+        return delta
+
+    def _gauss_seidel_iteration(self, one):
         delta = 0
 
-        for s in range(self.num_states):
-            v = self.values[s]
-            if s in self.grid.L and not one:
+        for s in self.compact.order:
+            if self.terminal[s] and not one:
                 continue
-            self.values[s] = max(sum(self.transition_model[s, a, s_next] * 
-                           (self.reward_function[s] + self.discount_factor * self.values[s_next])
-                           for s_next in range(self.num_states)) for a in range(self.num_actions))
-            delta = max(delta, abs(v - self.values[s]))
+            v = self.state_values[s]
+            self.state_values[s] = np.max(self.state_q_values(s))
+            self.backups += 1
+            delta = max(delta, abs(v - self.state_values[s]))
         return delta 
-    
+
+    def _backed_up_values(self, states):
+        """
+        Computes max_a Q(s, a) for an array of states.
+
+        When all states and actions share one row of successor probabilities,
+        as in the generated grid worlds, it is applied as one matrix product.
+        """
+        probs = self.transition_model.probs
+        if probs.strides[:2] != (0, 0):
+            return np.max(self.state_q_values(states), axis=-1)
+        row = probs[0, 0]
+        next_values = self.state_values[self.transition_model.next_states[states]]
+        return np.max(self.reward_function[states][:, None] * row.sum() + self.discount_factor * (next_values @ row), axis=1)
+
+    def _prioritized_sweeping(self):
+        """
+        Backs up the states with the largest Bellman errors, batch_size of them at a time.
+
+        Every step takes the batch_size states with the largest errors off the
+        frontier (the states with an error above theta), backs them up, and
+        re-scores all their predecessors together with one vectorized gather, as
+        only those can change their error. Re-scoring a state computes its backed
+        up value, which stays current until one of its successors changes and it
+        is re-scored again, so the backups themselves need no gather. Stops when the frontier is empty, i.e. no
+        state has a Bellman error above theta. The frontier and the predecessors
+        are found with boolean masks over all states, which for batches of a few
+        percent of the states costs less than keeping them sorted.
+
+        Returns:
+            list: The largest change per num_states backups, comparable to a sweep.
+        """
+        live = ~self.terminal
+        self.state_values[self.terminal] = self.terminal_values()[self.terminal]
+        self.backups = np.count_nonzero(self.terminal)
+        targets = np.max(self.q_values(), axis=1)
+        priority = np.where(live, np.abs(targets - self.state_values), 0)
+        priority[priority <= self.theta] = 0
+        frontier = np.flatnonzero(priority)
+        indptr, indices = self.transition_model.predecessors()
+        marked = np.zeros(self.num_states, dtype=bool)
+        delta_history = []
+        delta = 0
+        reported = self.backups
+        start = time.perf_counter()
+        while len(frontier):
+            states = frontier
+            if len(frontier) > self.batch_size:
+                states = frontier[np.argpartition(priority[frontier], -self.batch_size)[-self.batch_size:]]
+            priority[states] = 0
+            values = targets[states]
+            delta = max(delta, np.max(np.abs(values - self.state_values[states])))
+            self.state_values[states] = values
+            self.backups += len(states)
+            if self.backups - reported >= self.num_states:
+                self.report(len(delta_history), start, delta)
+                delta_history.append(delta)
+                delta = 0
+                reported = self.backups
+                start = time.perf_counter()
+            counts = indptr[states + 1] - indptr[states]
+            offsets = np.repeat(indptr[states] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            marked[indices[offsets]] = True
+            predecessors = np.flatnonzero(marked & live)
+            marked[:] = False
+            targets[predecessors] = self._backed_up_values(predecessors)
+            errors = np.abs(targets[predecessors] - self.state_values[predecessors])
+            errors[errors <= self.theta] = 0
+            priority[predecessors] = errors
+            frontier = np.flatnonzero(priority)
+        self.report(len(delta_history), start, delta)
+        delta_history.append(delta)
+        return delta_history
+
     def get_policy(self):
         """
         Extracts the policy from the value function.
 
         Returns:
-            np.ndarray: The policy for each state.
-        """
-        policy = np.zeros(self.num_states)
-        for s in range(self.num_states):
-            policy[s]= max(range(self.num_actions), 
-                            key=lambda a: sum(
-                            self.transition_model[s, a, s_next] *
-                                                    (self.reward_function[s] + self.discount_factor * self.values[s_next])
-                                                    for s_next in range(self.num_states)))
-            
-        return policy.astype(int)
+            np.ndarray: The policy for each grid state; walls get action 0.
+        """
+        return self.compact.scatter(np.argmax(self.q_values(), axis=1))
    
 
     def train(self):
         """
         Trains the value iteration model until convergence.
 
-        Args:
-            plot (bool, optional): Whether to plot the delta values over iterations. Default is False.
+        In 'sync' mode the policy is the greedy action recorded during the final sweep,
+        otherwise it is extracted from the converged values.
         """
+        if self.backup == 'prioritized':
+            self.delta_history = self._prioritized_sweeping()
+            self.policy = self.get_policy()
+            return
 
         epoch = 0
-        delta = self.one_iteration()
+        start = time.perf_counter()
+        delta = self.one_iteration(not self.warm_start)
+        self.report(epoch, start, delta)
         delta_history = [delta]
         while delta > self.theta:
             epoch += 1
+            start = time.perf_counter()
             delta = self.one_iteration(False)
+            self.report(epoch, start, delta)
             delta_history.append(delta)
             if delta < self.theta:
                 break
-        self.policy = self.get_policy()
+        self.policy = self.compact.scatter(self.greedy) if self.backup == 'sync' else self.get_policy()
         self.delta_history=delta_history
         
 
+class PolicyIteration(ValueIteration):
+    """
+    Class for performing policy iteration on a Markov Decision Process.
+
+    Each policy is evaluated exactly with one sparse linear solve and then
+    improved greedily, until the policy no longer changes. Terminal states keep
+    the value they get in the first sweep of value iteration.
+
+    Attributes:
+        tolerance (float): The minimum Q-value gain for changing the action of a state.
+    """
+
+    def __init__(self, grid: GridWorldBuilder, discount_factor=0.5, theta=0.01, tolerance=1e-9, metrics=None):
+        """
+        Initializes the PolicyIteration class with the given parameters.
+
+        Args:
+            grid (GridWorldBuilder): The grid world to solve.
+            discount_factor (float, optional): The discount factor for future rewards. Default is 0.5.
+            theta (float, optional): Unused by exact evaluation, kept for a uniform interface. Default is 0.01.
+            tolerance (float, optional): The minimum Q-value gain for changing an action. Default is 1e-9.
+            metrics (callable, optional): Called as metrics('iteration', fields) after every iteration.
+        """
+        super().__init__(grid, discount_factor, theta, metrics=metrics)
+        self.tolerance = tolerance
+
+    def policy_transition(self, policy):
+        """
+        Selects the successors and probabilities of the given policy.
+
+        Returns:
+            tuple: The successor states and probabilities, each shaped (num_states, K).
+        """
+        states = np.arange(self.num_states)
+        next_states = self.transition_model.next_states[states, policy]
+        probs = np.broadcast_to(self.transition_model.probs, self.transition_model.next_states.shape)[states, policy]
+        return next_states, probs
+
+    def evaluate(self, policy):
+        """
+        Computes the exact values of a policy with a sparse linear solve.
+
+        Solves (I - gamma * P_pi) V = P_pi R on the non-terminal states, with the
+        terminal states fixed to their terminal values. Every row of the
+        system only has entries for the outcomes of the policy's action, so it is
+        stored and solved with scipy.sparse instead of as a dense S x S matrix.
+
+        Args:
+            policy (np.ndarray): The action of every state.
+
+        Returns:
+            np.ndarray: The value of every state under the policy.
+        """
+        next_states, probs = self.policy_transition(policy)
+        live = ~self.terminal
+        states = np.broadcast_to(np.arange(self.num_states)[:, None], next_states.shape)
+        rows = np.concatenate([np.arange(self.num_states), states[live].ravel()])
+        cols = np.concatenate([np.arange(self.num_states), next_states[live].ravel()])
+        data = np.concatenate([np.ones(self.num_states), -self.discount_factor * probs[live].ravel()])
+        b = self.terminal_values()
+        b[live] = self.reward_function[live] * probs[live].sum(axis=1)
+        return spsolve(csr_matrix((data, (rows, cols)), shape=(self.num_states, self.num_states)), b)
+
+    def improve(self, policy):
+        """
+        Makes the policy greedy with respect to the current values.
+
+        An action only changes when another one is better by more than tolerance,
+        so ties cannot make the policy cycle.
+
+        Args:
+            policy (np.ndarray): The current action of every state.
+
+        Returns:
+            np.ndarray: The improved policy.
+        """
+        q = self.q_values()
+        current = q[np.arange(self.num_states), policy]
+        greedy = np.argmax(q, axis=1)
+        return np.where(np.max(q, axis=1) > current + self.tolerance, greedy, policy)
+
+    def train(self):
+        """
+        Trains the policy iteration model until the policy is stable.
+        """
+        policy = np.argmax(self.q_values(), axis=1)
+        delta_history = []
+        while True:
+            start = time.perf_counter()
+            values = self.evaluate(policy).astype(self.dtype)
+            delta_history.append(np.max(np.abs(values - self.state_values)))
+            self.state_values = values
+            new_policy = self.improve(policy)
+            self.backups += self.num_states
+            self.report(len(delta_history) - 1, start, delta_history[-1])
+            if np.array_equal(new_policy, policy):
+                break
+            policy = new_policy
+        self.policy = self.compact.scatter(policy)
+        self.delta_history = delta_history
+
+
+class ModifiedPolicyIteration(PolicyIteration):
+    """
+    Class for performing modified policy iteration on a Markov Decision Process.
+
+    Every iteration makes one greedy Bellman backup of all states, followed by
+    k sweeps evaluating the resulting policy, and stops like value iteration
+    once the greedy backup changes no value by more than theta.
+
+    Attributes:
+        k (int): The number of evaluation sweeps per iteration.
+    """
+
+    def __init__(self, grid: GridWorldBuilder, discount_factor=0.5, theta=0.01, k=5, metrics=None):
+        """
+        Initializes the ModifiedPolicyIteration class with the given parameters.
+
+        Args:
+            grid (GridWorldBuilder): The grid world to solve.
+            discount_factor (float, optional): The discount factor for future rewards. Default is 0.5.
+            theta (float, optional): The threshold for stopping the iteration. Default is 0.01.
+            k (int, optional): The number of evaluation sweeps per iteration. Default is 5.
+            metrics (callable, optional): Called as metrics('iteration', fields) after every iteration.
+        """
+        super().__init__(grid, discount_factor, theta, metrics=metrics)
+        self.k = k
+
+    def train(self):
+        """
+        Trains the modified policy iteration model until convergence.
+        """
+        live = ~self.terminal
+        self.state_values = self.terminal_values()
+        delta_history = []
+        while True:
+            start = time.perf_counter()
+            q = self.q_values()
+            policy = np.argmax(q, axis=1)
+            delta = np.max(np.abs(np.max(q, axis=1) - self.state_values)[live], initial=0)
+            delta_history.append(delta)
+            self.state_values[live] = np.max(q, axis=1)[live]
+            self.backups += self.num_states
+            if delta < self.theta:
+                self.report(len(delta_history) - 1, start, delta)
+                break
+            next_states, probs = self.policy_transition(policy)
+            for _ in range(self.k):
+                backup = np.sum(probs * (self.reward_function[:, None] + self.discount_factor * self.state_values[next_states]), axis=1)
+                self.state_values[live] = backup[live]
+            self.backups += self.k * np.count_nonzero(live)
+            self.report(len(delta_history) - 1, start, delta)
+        self.policy = self.compact.scatter(policy)
+        self.delta_history = delta_history
+
+
+class MultigridValueIteration(ValueIteration):
+    """
+    Class for performing coarse-to-fine value iteration on large grid worlds.
+
+    The grid world is coarsened into factor x factor blocks with
+    GridWorldBuilder.coarsen, recursively until it is at most min_size cells
+    on a side. The coarsest problem is solved from zero, and every level starts
+    from the values of the level below, interpolated bilinearly onto its cells
+    from the live coarse cells only. Terminal cells keep their own values, and
+    live cells that cannot reach a terminal start from their exact value,
+    r / (1 - discount_factor).
+
+    Attributes:
+        factor (int): The block size of each coarsening step.
+        min_size (int): The side length below which the grid is solved directly.
+        levels (int): The number of levels used, including this one.
+    """
+
+    def __init__(self, grid: GridWorldBuilder, discount_factor=0.5, theta=0.01, backup='sync', factor=2, min_size=32,
+                 metrics=None):
+        """
+        Initializes the MultigridValueIteration class with the given parameters.
+
+        Args:
+            grid (GridWorldBuilder): The grid world to solve.
+            discount_factor (float, optional): The discount factor for future rewards. Default is 0.5.
+            theta (float, optional): The threshold for stopping the iteration. Default is 0.01.
+            backup (str, optional): The backup mode of every level, see ValueIteration. Default is 'sync'.
+            factor (int, optional): The block size of each coarsening step. Default is 2.
+            min_size (int, optional): The side length below which the grid is solved directly. Default is 32.
+            metrics (callable, optional): Called as metrics('iteration', fields) after every iteration
+                of every level; the 'states' field tells the levels apart.
+        """
+        super().__init__(grid, discount_factor, theta, backup, metrics=metrics)
+        self.factor = factor
+        self.min_size = min_size
+        self.levels = 1
+
+    def interpolate(self, values, live):
+        """
+        Interpolates the values of a coarse grid bilinearly onto the cells of this grid.
+
+        Only live coarse cells take part; a cell with none around it gets zero.
+
+        Args:
+            values (np.ndarray): The coarse values, shape (h, w) of the coarse grid.
+            live (np.ndarray): Mask of the live coarse cells, same shape.
+
+        Returns:
+            np.ndarray: The interpolated values, shape (h, w) of this grid.
+        """
+        def corners(size, coarse_size):
+            position = np.clip((np.arange(size) + 0.5) / self.factor - 0.5, 0, coarse_size - 1)
+            low = np.minimum(position.astype(int), coarse_size - 1)
+            high = np.minimum(low + 1, coarse_size - 1)
+            weight = position - low
+            return (low, 1 - weight), (high, weight)
+
+        total = np.zeros((self.grid.h, self.grid.w), dtype=self.dtype)
+        weights = np.zeros_like(total)
+        for rows, row_weights in corners(self.grid.h, values.shape[0]):
+            for cols, col_weights in corners(self.grid.w, values.shape[1]):
+                weight = np.outer(row_weights, col_weights) * live[np.ix_(rows, cols)]
+                total += weight * values[np.ix_(rows, cols)]
+                weights += weight
+        return np.divide(total, weights, out=np.zeros_like(total), where=weights > 0)
+
+    def train(self):
+        """
+        Solves the coarser levels, projects their values up and refines on this level.
+        """
+        if min(self.grid.h, self.grid.w) > self.min_size:
+            coarse_grid = GridWorldBuilder(grids=[self.grid.coarsen(self.factor, self.discount_factor)],
+                                           dtype=self.dtype)
+            next(coarse_grid)
+            coarse = MultigridValueIteration(coarse_grid, self.discount_factor ** self.factor, self.theta,
+                                             self.backup, self.factor, self.min_size, self.metrics)
+            coarse.train()
+            values = self.interpolate(coarse.values.reshape(coarse_grid.h, coarse_grid.w),
+                                      ~coarse_grid.terminal.reshape(coarse_grid.h, coarse_grid.w))
+            values = values.ravel()[self.compact.states]
+            reaching = self.compact.reaching()
+            if not reaching.all():
+                values = np.where(reaching, values, self.reward_function / (1 - self.discount_factor))
+            self.state_values = np.where(self.terminal, self.terminal_values(), values)
+            self.warm_start = True
+            self.levels = coarse.levels + 1
+        super().train()
+
+
+class BatchValueIteration:
+    """
+    Class for performing synchronous value iteration on many grid worlds at once.
+
+    Every sweep backs up all states of all unconverged grid worlds in one tensor
+    operation. Each grid world stops when its own delta falls below theta, so the
+    per-grid results match ValueIteration(backup='sync').
+
+    Attributes:
+        batch (GridBatch): The stacked grid worlds.
+        discount_factor (float): The discount factor for future rewards.
+        theta (float): The threshold for stopping the iteration.
+    """
+
+    def __init__(self, batch: GridBatch, discount_factor=0.5, theta=0.01):
+        """
+        Initializes the BatchValueIteration class with the given parameters.
+
+        Args:
+            batch (GridBatch): The stacked grid worlds, e.g. from GridWorldBuilder.batch().
+            discount_factor (float, optional): The discount factor for future rewards. Default is 0.5.
+            theta (float, optional): The threshold for stopping the iteration. Default is 0.01.
+        """
+        self.batch = batch
+        self.discount_factor = discount_factor
+        self.theta = theta
+        self.values = None
+        self.policy = None
+        self.iterations = None
+        self.delta_history = None
+
+    def train(self):
+        """
+        Trains all grid worlds until each of them converges.
+
+        Sets values and policy (one unpadded array per grid world), iterations
+        and delta_history.
+        """
+        batch = self.batch
+        values = np.zeros((batch.num_grids, batch.num_states), dtype=batch.probs.dtype)
+        policy = np.zeros((batch.num_grids, batch.num_states), dtype=int)
+        iterations = np.zeros(batch.num_grids, dtype=int)
+        delta_history = [[] for _ in range(batch.num_grids)]
+        # The grid worlds still iterating and their rows of the batch, re-sliced only when some of them converge.
+        active = np.arange(batch.num_grids)
+        V = values
+        next_states, probs, terminal = batch.next_states, batch.probs, batch.terminal
+        rewards = batch.reward_table[:, :, None, None]
+        sweeps = 0
+        while len(active):
+            next_values = np.take_along_axis(V, next_states.reshape(len(active), -1), axis=1).reshape(next_states.shape)
+            q = np.sum(probs * (rewards + self.discount_factor * next_values), axis=-1)
+            new_values = np.max(q, axis=-1)
+            if sweeps:
+                new_values[terminal] = V[terminal]
+            deltas = np.max(np.abs(new_values - V), axis=1)
+            V = new_values
+            sweeps += 1
+            for g, delta in zip(active, deltas):
+                delta_history[g].append(delta)
+            done = deltas <= self.theta
+            if done.any():
+                values[active[done]] = V[done]
+                policy[active[done]] = np.argmax(q[done], axis=-1)
+                iterations[active[done]] = sweeps
+                keep = ~done
+                active, V = active[keep], V[keep]
+                next_states, probs, terminal, rewards = next_states[keep], probs[keep], terminal[keep], rewards[keep]
+        self.values = batch.unpad(values)
+        self.policy = batch.unpad(policy)
+        self.iterations = iterations
+        self.delta_history = delta_history
+
+
 if __name__ == "__main__":
     grids = GridWorldBuilder('GridWorld.py')
     for grid in grids:
@@ -1,15 +1,28 @@
+import abc
+import heapq
+from collections import deque
 import numpy as np
-from GridWorldBuilder import GridWorldBuilder
+from GridWorldBuilder import GridWorldBuilder, index_dtype
+from VecEnv import VecEnv
+from ReplayBuffer import ReplayBuffer
+from ActionSelector import ActionSelector
 import random
+import time
+from Metrics import peak_memory
 
 random.seed(42)
 
 class ModelFreeRL:
     """
     Q-Learning agent for solving grid world problems.
+
+    The agent works over the compact state index of the grid world, which
+    leaves out the walls: q_values, step_table, reward_vector and terminal
+    have one row per compact state, and get_policy and get_values scatter
+    the results back onto the grid.
     """
     
-    def __init__(self, grid: GridWorldBuilder, discount_factor=0.5, epsilon=0.01, decay=0.99, learning_rate=0.01, episodes=1000) -> None:
+    def __init__(self, grid: GridWorldBuilder, discount_factor=0.5, epsilon=0.01, decay=0.99, learning_rate=0.01, episodes=1000, replay: ReplayBuffer = None, seed=None, metrics=None, max_steps=None) -> None:
         """
         Initialize the QLearningAgent with given parameters.
 
@@ -20,6 +33,11 @@ class ModelFreeRL:
             decay (float): The decay rate for epsilon.
             learning_rate (float): The learning rate for Q-learning updates.
             episodes (int): The number of training episodes.
+            replay (ReplayBuffer): Optional buffer that retains the raw transitions.
+            seed (int): Seed for private random streams. By default they are seeded from the global random module.
+            metrics (callable): Called as metrics(event, fields) once per episode, e.g. a sink from Metrics.
+            max_steps (int): Cut training episodes off after this many steps. By default they run until
+                a terminal state, which never happens once the greedy policy avoids them.
         """
         self.grid = grid
         self.discount_factor = discount_factor
@@ -27,9 +45,21 @@ class ModelFreeRL:
         self.decay = decay
         self.learning_rate = learning_rate
         self.episodes = episodes
+        self.replay = replay
+        self.metrics = metrics
+        self.max_steps = max_steps
+        self.random = random if seed is None else random.Random(seed)
+        self.np_random = np.random.default_rng(self.random.getrandbits(64) if seed is None else seed)
+        self.selector = ActionSelector(self.grid.num_actions, self.np_random)
         self.rewards = self.initialize_rewards()
         self.actions = [(1, 0), (0, -1), (-1, 0), (0, 1)]
-        self.q_values = np.zeros((self.grid.num_states, self.grid.num_actions))
+        self.compact = self.grid.compact
+        self.num_states = self.compact.num_states
+        self.q_values = np.zeros((self.num_states, self.grid.num_actions), dtype=self.grid.dtype)
+        moves = self.grid.moves[self.compact.states]
+        self.step_table = self.compact.index[moves[:, [GridWorldBuilder.ACTIONS.index(a) for a in self.actions]]]
+        self.reward_vector = self.compact.reward
+        self.terminal = self.compact.terminal & (self.reward_vector != -1)
 
     def initialize_rewards(self):
         """
@@ -49,15 +79,12 @@ class ModelFreeRL:
         Select an action using the epsilon-greedy policy.
 
         Args:
-            state (int): The current state index.
+            state (int | np.ndarray): The current state index, or several of them.
 
         Returns:
-            int: The selected action.
+            int | np.ndarray: The selected action, or one action per state.
         """
-        if random.uniform(0, 1) < self.epsilon:
-            return random.randint(0, self.grid.num_actions - 1)
-        else:
-            return np.argmax(self.q_values[state])
+        return self.selector.epsilon_greedy(self.q_values[state], self.epsilon)
 
     def get_next_state(self, state, action):
         """
@@ -70,13 +97,7 @@ class ModelFreeRL:
         Returns:
             int: The next state index.
         """
-        r, c = self.grid.get_pos_from_state(state)
-        dr, dc = self.actions[action]
-        new_r, new_c = r + dr, c + dc
-        if new_r < 0 or new_c < 0 or new_r >= self.grid.h or new_c >= self.grid.w or ((new_r, new_c) in [(py, px) for px, py, val in self.rewards if val == 0]):
-            return state
-        else:
-            return self.grid.get_state_from_pos((new_r, new_c))
+        return self.step_table[state, action]
 
     def train(self):
         """
@@ -85,58 +106,704 @@ class ModelFreeRL:
         epsilon = self.epsilon
         
         for episode in range(self.episodes):
-            state = random.randint(0, self.grid.num_states - 1)
-            while state in [self.grid.get_state_from_pos((py, px)) for px, py, val in self.rewards if val != -1]:
-                state = random.randint(0, self.grid.num_states - 1)
-            while state not in [self.grid.get_state_from_pos((py, px)) for px, py, val in self.rewards if val != -1]:
+            start = time.perf_counter()
+            length, episode_return = 0, 0
+            state = self.start_state()
+            while not self.terminal[state] and (self.max_steps is None or length < self.max_steps):
                 action = self.epsilon_greedy_policy(state)
-                next_state = self.get_next_state(state, action)
-                reward = self.grid.reward_table[next_state]
+                next_state = self.step_table[state, action]
+                reward = self.reward_vector[next_state]
+                length += 1
+                episode_return += reward
                 best_next_action = np.max(self.q_values[next_state])
                 self.q_values[state][action] += self.learning_rate * (reward + self.discount_factor * best_next_action - self.q_values[state][action])
+                self.observe(state, action, reward, next_state)
                 state = next_state
             epsilon = max(0.01, epsilon * self.decay)
+            self.report_episode(episode, start, length, episode_return)
+
+    def start_state(self):
+        """
+        Draw the start state of a training episode uniformly from the non-terminal states.
+
+        Returns:
+            int: The state index.
+        """
+        state = self.random.randint(0, self.num_states - 1)
+        while self.terminal[state]:
+            state = self.random.randint(0, self.num_states - 1)
+        return state
+
+    def report_episode(self, episode, start, length, episode_return):
+        """
+        Send the 'episode' event of a finished training episode to the metrics sink, if there is one.
+
+        Args:
+            episode (int): The episode number.
+            start (float): The time.perf_counter() value at the start of the episode.
+            length (int): The number of steps taken.
+            episode_return (float): The sum of the rewards received.
+        """
+        if self.metrics is not None:
+            self.metrics('episode', {'solver': type(self).__name__, 'episode': episode,
+                                     'seconds': time.perf_counter() - start, 'length': length,
+                                     'return': float(episode_return), 'epsilon': self.epsilon,
+                                     'memory': peak_memory()})
+
+    def observe(self, state, action, reward, next_state):
+        """
+        Called with every real transition after its Q-learning update.
+
+        Stores the transition in the replay buffer, if there is one. Subclasses
+        extend it to learn from real experience beyond the Q-learning update.
+
+        Args:
+            state (int | np.ndarray): The state the transition starts from, or one per transition.
+            action (int | np.ndarray): The action taken.
+            reward (float | np.ndarray): The reward received.
+            next_state (int | np.ndarray): The state reached.
+        """
+        if self.replay is None:
+            return
+        if np.ndim(state):
+            self.replay.add_batch(state, action, reward, next_state)
+        else:
+            self.replay.add(state, action, reward, next_state)
+
+    def batch_update(self, states, actions, rewards, next_states, learning_rate=None):
+        """
+        Apply the Q-learning update for a batch of transitions at once.
+
+        All TD errors are computed from the Q-values before the batch, and the
+        errors of repeated (state, action) pairs are averaged so that a batch
+        moves each Q-value by at most one learning-rate step.
+
+        Args:
+            states (np.ndarray): The states the transitions start from.
+            actions (np.ndarray): The actions taken.
+            rewards (np.ndarray): The rewards received.
+            next_states (np.ndarray): The states reached.
+            learning_rate (float, optional): The step size. Default is the agent's learning rate.
+        """
+        if learning_rate is None:
+            learning_rate = self.learning_rate
+        best_next_action = np.max(self.q_values[next_states], axis=1)
+        td_error = rewards + self.discount_factor * best_next_action - self.q_values[states, actions]
+        pairs, index, counts = np.unique(states * self.grid.num_actions + actions,
+                                         return_inverse=True, return_counts=True)
+        mean_error = np.bincount(index.ravel(), weights=td_error, minlength=len(pairs)) / counts
+        self.q_values.ravel()[pairs] += learning_rate * mean_error
+
+    def train_vectorized(self, steps, num_envs=256, seed=None):
+        """
+        Train the Q-learning agent on num_envs episodes advanced in lockstep.
+
+        Every tick selects epsilon-greedy actions for all episodes, steps a
+        VecEnv and applies all num_envs updates with batch_update. With metrics
+        set, every tick is reported as a 'step' event with the length and return
+        of the episodes that finished in it.
+
+        Args:
+            steps (int): The number of ticks, each performing num_envs updates.
+            num_envs (int): The number of episodes run side by side.
+            seed (int): Seed for the exploration and start-state random generator.
+                By default it is drawn from the agent's random stream.
+        """
+        if seed is None:
+            seed = self.random.getrandbits(32)
+        env = VecEnv(self.step_table, self.reward_vector, self.terminal, num_envs, seed)
+        selector = ActionSelector(self.grid.num_actions, env.rng)
+        states = env.states
+        lengths = np.zeros(num_envs, dtype=int)
+        returns = np.zeros(num_envs)
+        for step in range(steps):
+            start = time.perf_counter()
+            actions = selector.epsilon_greedy(self.q_values[states], self.epsilon)
+            next_states, rewards, dones = env.step(actions)
+            self.batch_update(states, actions, rewards, next_states)
+            self.observe(states, actions, rewards, next_states)
+            states = env.states
+            if self.metrics is not None:
+                lengths += 1
+                returns += rewards
+                finished = np.count_nonzero(dones)
+                self.metrics('step', {'solver': type(self).__name__, 'step': step, 'seconds': time.perf_counter() - start,
+                                      'updates': num_envs, 'episodes': finished,
+                                      'length': float(lengths[dones].mean()) if finished else None,
+                                      'return': float(returns[dones].mean()) if finished else None,
+                                      'epsilon': self.epsilon, 'memory': peak_memory()})
+                lengths[dones] = 0
+                returns[dones] = 0
 
     def get_policy(self):
         """
         Extract the optimal policy from the Q-values.
 
         Returns:
-            np.ndarray: The optimal policy.
+            np.ndarray: The optimal policy, shaped like the grid; 0 in walls.
         """
-        policy = np.zeros((self.grid.h, self.grid.w), dtype=int)
-        for r in range(self.grid.h):
-            for c in range(self.grid.w):
-                state = self.grid.get_state_from_pos((r, c))
-                policy[r][c] = np.argmax(self.q_values[state])
-        return policy
+        return self.compact.scatter(np.argmax(self.q_values, axis=1)).reshape(self.grid.h, self.grid.w)
 
     def get_values(self):
         """
         Extract the state values from the Q-values.
 
         Returns:
-            np.ndarray: The state values.
-        """
-        values = np.zeros((self.grid.h, self.grid.w))
-        for r in range(self.grid.h):
-            for c in range(self.grid.w):
-                state = self.grid.get_state_from_pos((r, c))
-                values[r][c] = np.max(self.q_values[state])
-        return values
+            np.ndarray: The state values, shaped like the grid; 0 in walls.
+        """
+        return self.get_values_().reshape(self.grid.h, self.grid.w)
+
     def get_values_(self):
         """
         Extract the state values from the Q-values.
 
         Returns:
-            np.ndarray: The state values.
-        """
-        values = np.zeros(self.grid.h*self.grid.w)
-        for r in range(self.grid.h):
-            for c in range(self.grid.w):
-                state = self.grid.get_state_from_pos((r, c))
-                values[state] = np.max(self.q_values[state])
-        return values
+            np.ndarray: The value of every grid state; 0 in walls.
+        """
+        return self.compact.scatter(np.max(self.q_values, axis=1).astype(float))
+
+class DynaQ(ModelFreeRL):
+    """
+    Dyna-Q agent: Q-learning that also plans on a learned tabular model.
+
+    Every real transition is recorded in a table over (state, action) pairs
+    holding the last observed reward and next state, and is followed by
+    planning_steps simulated updates on pairs drawn from that table, applied
+    together with batch_update. By default the pairs are drawn uniformly from
+    the ones observed so far. With prioritized set, they are the pairs with
+    the largest TD error under the model instead; whenever the Q-values of a
+    state change, the errors of the pairs leading into it are recomputed, so
+    value changes spread backwards as in prioritized sweeping. The pairs
+    leading into every state are kept as linked lists in two index arrays,
+    which, like the priorities, only exist in prioritized mode.
+
+    Attributes:
+        planning_steps (int): The simulated updates per real transition.
+        planning_rate (float): The step size of the simulated updates.
+        prioritized (bool): Whether the pairs with the largest TD error are replayed first.
+        theta (float): The smallest TD error at which a pair is queued for replay.
+        model_next_states (np.ndarray): The next state of every pair, indexed by
+            state * num_actions + action, -1 where the pair was not observed yet.
+        model_rewards (np.ndarray): The reward of every pair.
+        priorities (np.ndarray): The current absolute TD error of every queued pair, None unless prioritized.
+        planning_updates (int): The number of simulated updates so far.
+    """
+
+    def __init__(self, grid: GridWorldBuilder, discount_factor=0.5, planning_steps=10, planning_rate=None,
+                 prioritized=False, theta=1e-4, max_steps=1000, **kwargs) -> None:
+        """
+        Initialize the agent and an empty model.
+
+        Args:
+            grid (GridWorldBuilder): The grid world builder instance.
+            discount_factor (float): The discount factor for future rewards.
+            planning_steps (int): The simulated updates per real transition.
+            planning_rate (float, optional): The step size of the simulated updates. Default is the
+                learning rate. The grid world moves deterministically, so the model is exact and 1.0
+                turns every simulated update into a full Bellman backup.
+            prioritized (bool): Replay the pairs with the largest TD error first instead of uniformly.
+            theta (float): The smallest TD error at which a pair is queued for replay.
+            max_steps (int): Cut training episodes off after this many steps. Planning finds policies that
+                avoid terminal states much sooner, so unlike in ModelFreeRL the default is finite.
+            **kwargs: The remaining arguments of ModelFreeRL.
+        """
+        super().__init__(grid, discount_factor, max_steps=max_steps, **kwargs)
+        self.planning_steps = planning_steps
+        self.planning_rate = self.learning_rate if planning_rate is None else planning_rate
+        self.prioritized = prioritized
+        self.theta = theta
+        num_pairs = self.num_states * self.grid.num_actions
+        self.model_next_states = np.full(num_pairs, -1, dtype=self.step_table.dtype)
+        self.model_rewards = np.zeros(num_pairs, dtype=self.grid.dtype)
+        self.planning_updates = 0
+        self._observed = np.zeros(num_pairs, dtype=index_dtype(num_pairs))
+        self._num_observed = 0
+        self.priorities = None
+        if prioritized:
+            self.priorities = np.zeros(num_pairs, dtype=self.grid.dtype)
+            # _heads[s] is the first observed pair leading into s, _links[pair] the next one, -1 ends a list.
+            self._heads = np.full(self.num_states, -1, dtype=self._observed.dtype)
+            self._links = np.full(num_pairs, -1, dtype=self._observed.dtype)
+            self._queue = []
+
+    def record(self, states, actions, rewards, next_states):
+        """
+        Record real transitions in the model.
+
+        Args:
+            states (int | np.ndarray): The states the transitions start from.
+            actions (int | np.ndarray): The actions taken.
+            rewards (float | np.ndarray): The rewards received.
+            next_states (int | np.ndarray): The states reached.
+
+        Returns:
+            np.ndarray: The (state, action) pairs of the transitions.
+        """
+        pairs = np.atleast_1d(np.asarray(states) * self.grid.num_actions + actions).astype(np.int64)
+        next_states = np.atleast_1d(next_states)
+        previous = self.model_next_states[pairs]
+        new = pairs[previous < 0]
+        if len(new):
+            new = np.unique(new)
+            self._observed[self._num_observed:self._num_observed + len(new)] = new
+            self._num_observed += len(new)
+        if self.prioritized:
+            changed = previous != next_states
+            for pair, state in zip(pairs[changed].tolist(), next_states[changed].tolist()):
+                self._relink(pair, state)
+        self.model_next_states[pairs] = next_states
+        self.model_rewards[pairs] = rewards
+        return pairs
+
+    def _relink(self, pair, state):
+        """
+        Moves a pair into the predecessor list of the state it now leads to.
+        """
+        old = self.model_next_states[pair]
+        if old == state:
+            return
+        if old >= 0:
+            if self._heads[old] == pair:
+                self._heads[old] = self._links[pair]
+            else:
+                previous = self._heads[old]
+                while self._links[previous] != pair:
+                    previous = self._links[previous]
+                self._links[previous] = self._links[pair]
+        self._links[pair] = self._heads[state]
+        self._heads[state] = pair
+        self.model_next_states[pair] = state
+
+    def predecessors(self, states):
+        """
+        Return the observed pairs leading into any of the given states (prioritized mode only).
+
+        The predecessor lists of all states are walked side by side, one array step per list position.
+
+        Args:
+            states (np.ndarray): The states. A state given twice yields its pairs twice.
+
+        Returns:
+            np.ndarray: The pairs.
+        """
+        found = []
+        pairs = self._heads[states]
+        pairs = pairs[pairs >= 0]
+        while len(pairs):
+            found.append(pairs)
+            pairs = self._links[pairs]
+            pairs = pairs[pairs >= 0]
+        return np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+
+    def _reprioritize(self, pairs):
+        """
+        Recompute the TD errors of pairs whose target or value may have changed and queue the large ones.
+
+        Besides the given pairs, this covers every pair that leads into one of their states.
+
+        Args:
+            pairs (np.ndarray): The pairs whose Q-values changed.
+        """
+        pairs = np.unique(np.concatenate([pairs, self.predecessors(pairs // self.grid.num_actions)]))
+        targets = self.model_rewards[pairs] + self.discount_factor * np.max(
+            self.q_values[self.model_next_states[pairs]], axis=1)
+        errors = np.abs(targets - self.q_values.ravel()[pairs])
+        self.priorities[pairs] = errors
+        queued = errors > self.theta
+        for error, pair in zip(errors[queued].tolist(), pairs[queued].tolist()):
+            heapq.heappush(self._queue, (-error, pair))
+
+    def _pop(self, n):
+        """
+        Take up to n distinct pairs with the largest TD errors off the queue.
+
+        Entries whose priority was recomputed since they were queued are skipped.
+        """
+        pairs = []
+        while self._queue and len(pairs) < n:
+            error, pair = heapq.heappop(self._queue)
+            if -error == self.priorities[pair]:
+                self.priorities[pair] = 0
+                pairs.append(pair)
+        return np.array(pairs, dtype=np.int64)
+
+    def plan(self, n):
+        """
+        Apply n simulated Q-learning updates from the model as one batch.
+
+        All targets are computed from the Q-values before the batch, as in batch_update.
+
+        Args:
+            n (int): The number of updates.
+
+        Returns:
+            int: The number of updates applied, fewer than n when the prioritized queue runs empty.
+        """
+        if self.prioritized:
+            pairs = self._pop(n)
+        elif self._num_observed:
+            pairs = self._observed[self.np_random.integers(0, self._num_observed, n)]
+        else:
+            return 0
+        if len(pairs) == 0:
+            return 0
+        # Copies of a pair drawn twice share their target, so unlike batch_update
+        # this needs no averaging: the buffered update applies the pair once.
+        q_values = self.q_values.ravel()
+        targets = self.model_rewards[pairs] + self.discount_factor * np.max(
+            self.q_values[self.model_next_states[pairs]], axis=1)
+        q_values[pairs] += self.planning_rate * (targets - q_values[pairs])
+        if self.prioritized:
+            self._reprioritize(pairs)
+        self.planning_updates += len(pairs)
+        return len(pairs)
+
+    def observe(self, state, action, reward, next_state):
+        """
+        Record real transitions in the model and plan planning_steps updates for each of them.
+
+        Args:
+            state (int | np.ndarray): The state the transition starts from, or one per transition.
+            action (int | np.ndarray): The action taken.
+            reward (float | np.ndarray): The reward received.
+            next_state (int | np.ndarray): The state reached.
+        """
+        super().observe(state, action, reward, next_state)
+        pairs = self.record(state, action, reward, next_state)
+        if self.prioritized:
+            self._reprioritize(pairs)
+        self.plan(self.planning_steps * len(pairs))
+
+class OnlineTD(abc.ABC):
+    """
+    Base of the TD learners that learn on-line from the episodes they run.
+
+    A learner holds a ModelFreeRL agent for its Q-values, exploration, start
+    states, replay buffer and metrics instead of being one, so the one-step
+    Q-learning of batch_update and train_vectorized is not part of its
+    interface. train() picks the next epsilon-greedy action before learning
+    from a step, as the SARSA targets need, and hands every step to learn().
+    Subclasses keep what they need from the current episode between
+    begin_episode() and end_episode().
+
+    Attributes:
+        agent (ModelFreeRL): The agent holding the Q-values, exploring and reporting for the learner.
+        method (str): 'q' bootstraps from the greedy action, 'sarsa' from the action taken.
+        episodes (int): The number of training episodes.
+        max_steps (int): Training episodes are cut off after this many steps.
+    """
+
+    METHODS = ('q', 'sarsa')
+
+    def __init__(self, grid: GridWorldBuilder, discount_factor=0.5, method='q', episodes=1000, max_steps=1000,
+                 metrics=None, **kwargs) -> None:
+        """
+        Initialize the learner.
+
+        Args:
+            grid (GridWorldBuilder): The grid world builder instance.
+            discount_factor (float): The discount factor for future rewards.
+            method (str): 'q' for Q-learning targets, 'sarsa' for SARSA targets.
+            episodes (int): The number of training episodes.
+            max_steps (int): Cut training episodes off after this many steps. As in DynaQ the default is
+                finite: with a positive living reward the learners soon stop reaching terminal states.
+            metrics (callable): Called as metrics(event, fields) once per episode, e.g. a sink from Metrics.
+            **kwargs: The remaining arguments of ModelFreeRL.
+        """
+        if method not in self.METHODS:
+            raise ValueError(f"Unknown method {method!r}, expected one of {self.METHODS}")
+        if metrics is not None:
+            solver = type(self).__name__
+            metrics = lambda event, fields, report=metrics: report(event, dict(fields, solver=solver))
+        self.agent = ModelFreeRL(grid, discount_factor, metrics=metrics, **kwargs)
+        self.method = method
+        self.episodes = episodes
+        self.max_steps = max_steps
+
+    @property
+    def grid(self):
+        """
+        The grid world of the agent.
+        """
+        return self.agent.grid
+
+    @property
+    def discount_factor(self):
+        """
+        The discount factor of the agent.
+        """
+        return self.agent.discount_factor
+
+    @property
+    def learning_rate(self):
+        """
+        The learning rate of the agent.
+        """
+        return self.agent.learning_rate
+
+    @property
+    def q_values(self):
+        """
+        The Q-values of the agent, updated in place by learn().
+        """
+        return self.agent.q_values
+
+    @property
+    def num_states(self):
+        """
+        The number of states of the agent, see ModelFreeRL.
+        """
+        return self.agent.num_states
+
+    @property
+    def reward_vector(self):
+        """
+        The reward received when entering each state, see ModelFreeRL.
+        """
+        return self.agent.reward_vector
+
+    @property
+    def step_table(self):
+        """
+        The next state for every state and action, see ModelFreeRL.
+        """
+        return self.agent.step_table
+
+    @property
+    def terminal(self):
+        """
+        Mask of the states that end an episode, see ModelFreeRL.
+        """
+        return self.agent.terminal
+
+    def get_policy(self):
+        """
+        Extract the greedy policy from the Q-values, see ModelFreeRL.get_policy.
+        """
+        return self.agent.get_policy()
+
+    def get_values(self):
+        """
+        Extract the state values from the Q-values, see ModelFreeRL.get_values.
+        """
+        return self.agent.get_values()
+
+    def get_values_(self):
+        """
+        Extract the state values from the Q-values, see ModelFreeRL.get_values_.
+        """
+        return self.agent.get_values_()
+
+    def bootstrap(self, state, action):
+        """
+        Return the value a target bootstraps from after reaching state and picking action there.
+        """
+        row = self.q_values[state]
+        return row.max() if self.method == 'q' else row[action]
+
+    def is_greedy(self, state, action):
+        """
+        Return whether action has the largest Q-value of state, ties included.
+        """
+        row = self.q_values[state]
+        return row[action] == row.max()
+
+    def train(self):
+        """
+        Train the learner on self.episodes episodes.
+        """
+        agent = self.agent
+        for episode in range(self.episodes):
+            start = time.perf_counter()
+            length, episode_return = 0, 0
+            state = agent.start_state()
+            action = agent.epsilon_greedy_policy(state)
+            self.begin_episode()
+            while not self.terminal[state] and (self.max_steps is None or length < self.max_steps):
+                next_state = self.step_table[state, action]
+                reward = self.reward_vector[next_state]
+                next_action = agent.epsilon_greedy_policy(next_state)
+                length += 1
+                episode_return += reward
+                self.learn(state, action, reward, next_state, next_action)
+                agent.observe(state, action, reward, next_state)
+                state, action = next_state, next_action
+            self.end_episode(state, action)
+            agent.report_episode(episode, start, length, episode_return)
+
+    def begin_episode(self):
+        """
+        Called before the first step of every episode.
+        """
+
+    @abc.abstractmethod
+    def learn(self, state, action, reward, next_state, next_action):
+        """
+        Learn from one step of the current episode.
+
+        Args:
+            state (int): The state the step starts from.
+            action (int): The action taken.
+            reward (float): The reward received.
+            next_state (int): The state reached.
+            next_action (int): The action that will be taken in next_state.
+        """
+
+    def end_episode(self, state, action):
+        """
+        Called after the last step of every episode.
+
+        Args:
+            state (int): The last state, terminal unless the episode was cut off after max_steps.
+            action (int): The action that would have been taken there.
+        """
+
+
+class TDLambda(OnlineTD):
+    """
+    Q(lambda) and SARSA(lambda) with sparse replacing eligibility traces.
+
+    Only recently visited pairs carry a trace. The traces decay by
+    discount_factor * trace_decay every step and are dropped below
+    trace_threshold, so at most log(trace_threshold) / log(discount_factor *
+    trace_decay) pairs carry one. They are kept in two preallocated arrays of
+    that length, and every update touches only those pairs instead of the
+    whole table. With method 'q' (Watkins's Q(lambda)) all traces are cut
+    before an exploratory action, whose outcome says nothing about the greedy
+    policy.
+
+    Attributes:
+        trace_decay (float): The lambda parameter; 0 gives one-step TD.
+        trace_threshold (float): Traces below this value are dropped.
+    """
+
+    def __init__(self, grid: GridWorldBuilder, discount_factor=0.5, trace_decay=0.5, method='q',
+                 trace_threshold=1e-3, **kwargs) -> None:
+        """
+        Initialize the learner.
+
+        Args:
+            grid (GridWorldBuilder): The grid world builder instance.
+            discount_factor (float): The discount factor for future rewards.
+            trace_decay (float): The lambda parameter; 0 gives one-step TD.
+            method (str): 'q' for Watkins's Q(lambda), 'sarsa' for SARSA(lambda).
+            trace_threshold (float): Traces below this value are dropped.
+            **kwargs: The remaining arguments of ModelFreeRL.
+        """
+        super().__init__(grid, discount_factor, method, **kwargs)
+        self.trace_decay = trace_decay
+        self.trace_threshold = trace_threshold
+        decay = discount_factor * trace_decay
+        capacity = self.num_states * self.grid.num_actions
+        if decay < 1:
+            capacity = min(capacity, 2 + int(np.log(trace_threshold) / np.log(decay)) if decay > 0 else 1)
+        self._trace_pairs = np.zeros(capacity, dtype=index_dtype(self.num_states * self.grid.num_actions))
+        self._traces = np.zeros(capacity, dtype=self.grid.dtype)
+        self._num_traces = 0
+
+    @property
+    def trace_pairs(self):
+        """
+        The pairs that carry a trace, indexed by state * num_actions + action.
+        """
+        return self._trace_pairs[:self._num_traces]
+
+    @property
+    def traces(self):
+        """
+        The trace of every pair in trace_pairs.
+        """
+        return self._traces[:self._num_traces]
+
+    def begin_episode(self):
+        self._num_traces = 0
+
+    def learn(self, state, action, reward, next_state, next_action):
+        q_values = self.q_values.ravel()
+        pair = state * self.grid.num_actions + action
+        delta = reward + self.discount_factor * self.bootstrap(next_state, next_action) - q_values[pair]
+        n = self._num_traces
+        visited = np.flatnonzero(self._trace_pairs[:n] == pair)
+        if len(visited):
+            self._traces[visited[0]] = 1
+        else:
+            self._trace_pairs[n] = pair
+            self._traces[n] = 1
+            n += 1
+        pairs, traces = self._trace_pairs[:n], self._traces[:n]
+        q_values[pairs] += self.learning_rate * delta * traces
+        if self.method == 'q' and not self.is_greedy(next_state, next_action):
+            n = 0
+        else:
+            traces *= self.discount_factor * self.trace_decay
+            kept = traces >= self.trace_threshold
+            if not kept.all():
+                n = np.count_nonzero(kept)
+                pairs[:n], traces[:n] = pairs[kept], traces[kept]
+        self._num_traces = n
+
+
+class NStepTD(OnlineTD):
+    """
+    n-step Q-learning and n-step SARSA.
+
+    Every pair is updated n steps after it was visited, towards the discounted
+    sum of the n rewards that followed plus the discounted bootstrap value of
+    the state reached then. Only the last n pairs and rewards of the episode
+    are kept. With method 'q' the returns are cut before an exploratory
+    action, as the traces of Watkins's Q(lambda) are: all pending pairs are
+    updated right away and bootstrap from the greedy value of the state the
+    exploratory action is taken in.
+
+    Attributes:
+        n (int): The largest number of rewards in a target.
+    """
+
+    def __init__(self, grid: GridWorldBuilder, discount_factor=0.5, n=4, method='q', **kwargs) -> None:
+        """
+        Initialize the learner.
+
+        Args:
+            grid (GridWorldBuilder): The grid world builder instance.
+            discount_factor (float): The discount factor for future rewards.
+            n (int): The largest number of rewards in a target; 1 gives one-step TD.
+            method (str): 'q' for n-step Q-learning, 'sarsa' for n-step SARSA.
+            **kwargs: The remaining arguments of ModelFreeRL.
+        """
+        if n < 1:
+            raise ValueError(f"n must be at least 1, got {n}")
+        super().__init__(grid, discount_factor, method, **kwargs)
+        self.n = n
+        self._discounts = discount_factor ** np.arange(n + 1)
+        self.begin_episode()
+
+    def begin_episode(self):
+        self._pairs = deque()
+        self._rewards = deque()
+
+    def _update_oldest(self, bootstrap):
+        """
+        Update the oldest pending pair towards its rewards and the given bootstrap value, and forget it.
+        """
+        k = len(self._rewards)
+        target = np.dot(self._discounts[:k], self._rewards) + self._discounts[k] * bootstrap
+        q_values = self.q_values.ravel()
+        pair = self._pairs.popleft()
+        self._rewards.popleft()
+        q_values[pair] += self.learning_rate * (target - q_values[pair])
+
+    def learn(self, state, action, reward, next_state, next_action):
+        self._pairs.append(state * self.grid.num_actions + action)
+        self._rewards.append(reward)
+        if self.method == 'q' and not self.is_greedy(next_state, next_action):
+            self.end_episode(next_state, next_action)
+        elif len(self._pairs) == self.n:
+            self._update_oldest(self.bootstrap(next_state, next_action))
+
+    def end_episode(self, state, action):
+        bootstrap = self.bootstrap(state, action)
+        while self._pairs:
+            self._update_oldest(bootstrap)
 
 # Main function
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+import json
+import sys
+from collections import deque
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_memory():
+    """
+    Returns the peak resident memory of the process in bytes, or None where it cannot be read.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+class RingBufferSink:
+    """
+    Metrics sink that keeps the most recent events in memory.
+
+    Solvers call a sink once per iteration or episode as sink(event, fields),
+    where event names the kind of record ('iteration', 'episode' or 'step')
+    and fields is a dictionary. Any callable with that signature can be used
+    as a sink instead.
+
+    Attributes:
+        events (collections.deque): The (event, fields) pairs, oldest first.
+    """
+
+    def __init__(self, capacity=100000):
+        """
+        Initializes the sink.
+
+        Args:
+            capacity (int): The number of events kept; older ones are dropped.
+        """
+        self.events = deque(maxlen=capacity)
+
+    def __call__(self, event, fields):
+        self.events.append((event, fields))
+
+    def records(self, event=None):
+        """
+        Returns the kept events as dictionaries with an 'event' key.
+
+        Args:
+            event (str, optional): Only return events of this kind. Default is all events.
+
+        Returns:
+            list: The events, oldest first.
+        """
+        return [dict(fields, event=name) for name, fields in self.events if event is None or name == event]
+
+
+class JsonLinesSink:
+    """
+    Metrics sink that appends every event to a file as one JSON object per line.
+
+    Writes go through a large file buffer, so the solvers do not wait on disk.
+    Close the sink, or use it as a context manager, to flush the buffer.
+
+    Attributes:
+        file (file): The open output file.
+    """
+
+    def __init__(self, filename, buffer_size=1 << 16):
+        """
+        Opens the output file for appending.
+
+        Args:
+            filename (str): The file to write.
+            buffer_size (int): The size of the write buffer in bytes.
+        """
+        self.file = open(filename, 'a', buffering=buffer_size)
+
+    def __call__(self, event, fields):
+        self.file.write(json.dumps(dict(fields, event=event), default=self._plain) + '\n')
+
+    @staticmethod
+    def _plain(value):
+        if isinstance(value, np.generic):
+            return value.item()
+        raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,90 @@
+import numpy as np
+
+
+class ReplayBuffer:
+    """
+    Fixed-capacity replay store for (state, action, reward, next_state) transitions.
+
+    Transitions live in contiguous int32/float32 columns used as a ring
+    buffer: once the buffer is full the oldest transitions are overwritten.
+
+    Attributes:
+        capacity (int): The maximum number of transitions kept.
+        states (np.ndarray): The state column.
+        actions (np.ndarray): The action column.
+        rewards (np.ndarray): The reward column.
+        next_states (np.ndarray): The next state column.
+        position (int): The row the next transition is written to.
+        size (int): The number of transitions currently stored.
+        rng (np.random.Generator): The random generator used for sampling.
+    """
+
+    def __init__(self, capacity, seed=None):
+        """
+        Allocate the buffer columns.
+
+        Args:
+            capacity (int): The maximum number of transitions kept.
+            seed (int): Seed for the sampling random generator.
+        """
+        self.capacity = capacity
+        self.states = np.zeros(capacity, dtype=np.int32)
+        self.actions = np.zeros(capacity, dtype=np.int32)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.next_states = np.zeros(capacity, dtype=np.int32)
+        self.position = 0
+        self.size = 0
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, state, action, reward, next_state):
+        """
+        Store one transition, evicting the oldest one when the buffer is full.
+
+        Args:
+            state (int): The state the transition starts from.
+            action (int): The action taken.
+            reward (float): The reward received.
+            next_state (int): The state reached.
+        """
+        i = self.position
+        self.states[i] = state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.next_states[i] = next_state
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def add_batch(self, states, actions, rewards, next_states):
+        """
+        Store a batch of transitions in arrival order.
+
+        Args:
+            states (np.ndarray): The states the transitions start from.
+            actions (np.ndarray): The actions taken.
+            rewards (np.ndarray): The rewards received.
+            next_states (np.ndarray): The states reached.
+        """
+        n = min(len(states), self.capacity)
+        rows = (self.position + np.arange(n)) % self.capacity
+        self.states[rows] = states[-n:]
+        self.actions[rows] = actions[-n:]
+        self.rewards[rows] = rewards[-n:]
+        self.next_states[rows] = next_states[-n:]
+        self.position = (self.position + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def sample(self, batch_size):
+        """
+        Draw a batch of stored transitions uniformly with replacement.
+
+        Args:
+            batch_size (int): The number of transitions to draw.
+
+        Returns:
+            tuple: The states, actions, rewards and next states of the batch.
+        """
+        rows = self.rng.integers(0, self.size, batch_size)
+        return self.states[rows], self.actions[rows], self.rewards[rows], self.next_states[rows]
@@ -0,0 +1,91 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from GridCache import GridCache
+from GridWorldBuilder import DefinitionFile, Grid
+from MDP import ValueIteration
+from MBRL import ModelBasedRL
+from MFRL import ModelFreeRL, DynaQ, TDLambda, NStepTD
+
+# The model-free agents, trained with train() and read out with get_values_() and get_policy().
+AGENTS = {'ModelFreeRL': ModelFreeRL, 'DynaQ': DynaQ, 'TDLambda': TDLambda, 'NStepTD': NStepTD}
+SOLVERS = ('ValueIteration', 'ModelBasedRL') + tuple(AGENTS)
+
+
+def make_jobs(filename, grids, solvers=SOLVERS, params=None, seeds=1, base_seed=42, cache_dir=None):
+    """
+    Build the (grid, solver, hyperparameters, seed) jobs of an experiment.
+
+    Every job gets its own seed spawned from base_seed, so results do not
+    depend on which worker runs a job or in which order. The file is indexed
+    once here, and every job carries the block of its grid world, so workers
+    read and parse only that block.
+
+    Args:
+        filename (str): The grid world definitions file.
+        grids (list): Indices of the grid worlds to solve.
+        solvers (list): Names of the solvers to run, see SOLVERS.
+        params (dict): Keyword arguments for each solver, keyed by solver name.
+        seeds (int): The number of seeds to run for every grid and solver.
+        base_seed (int): The seed all job seeds are spawned from.
+        cache_dir (str): Directory of a GridCache shared by the workers.
+
+    Returns:
+        list: The jobs, as dictionaries.
+    """
+    params = params or {}
+    blocks = DefinitionFile(filename).blocks
+    combinations = [(grid, solver, i) for grid in grids for solver in solvers for i in range(seeds)]
+    streams = np.random.SeedSequence(base_seed).spawn(len(combinations))
+    return [{'filename': filename, 'cache_dir': cache_dir, 'grid': grid, 'block': blocks[grid], 'solver': solver,
+             'params': dict(params.get(solver, {})), 'seed': int(stream.generate_state(1)[0])}
+            for (grid, solver, i), stream in zip(combinations, streams)]
+
+
+def run_job(job):
+    """
+    Build the grid world of a job and run its solver.
+
+    Args:
+        job (dict): A job from make_jobs.
+
+    Returns:
+        dict: The job together with the resulting values, policy and wall time in seconds.
+    """
+    cache = None if job['cache_dir'] is None else GridCache(job['cache_dir'])
+    grids = Grid(DefinitionFile(job['filename'], cache, blocks=[job['block']])[0], cache)
+    start = time.perf_counter()
+    if job['solver'] == 'ValueIteration':
+        solver = ValueIteration(grids, **job['params'])
+        solver.train()
+        values, policy = solver.values, solver.policy
+    elif job['solver'] == 'ModelBasedRL':
+        agent = ModelBasedRL(grids, seed=job['seed'], **job['params'])
+        policy = agent.iterative_policy_learning()
+        values = agent.compact.scatter(np.max(agent.q_values, axis=1))
+    elif job['solver'] in AGENTS:
+        agent = AGENTS[job['solver']](grids, seed=job['seed'], **job['params'])
+        agent.train()
+        values, policy = agent.get_values_(), agent.get_policy()
+    else:
+        raise ValueError(f"Unknown solver {job['solver']!r}, expected one of {SOLVERS}")
+    seconds = time.perf_counter() - start
+    return dict(job, values=np.asarray(values).ravel().tolist(), policy=np.asarray(policy).ravel().tolist(),
+                seconds=seconds)
+
+
+def run_experiments(jobs, workers=None):
+    """
+    Run jobs on a process pool and yield their results as they finish.
+
+    Args:
+        jobs (list): Jobs from make_jobs.
+        workers (int): The number of worker processes. Default is the number of CPUs.
+
+    Yields:
+        dict: The result of each job, in completion order.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_job, job) for job in jobs]
+        for future in as_completed(futures):
+            yield future.result()
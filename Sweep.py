@@ -0,0 +1,113 @@
+import itertools
+import numpy as np
+from GridWorldBuilder import GridWorldBuilder
+from MDP import ValueIteration
+
+
+class ParameterSweep:
+    """
+    Solves grid worlds over a grid of discount factors, slip probabilities and step rewards.
+
+    Grid worlds with the same size and L share their move table, which is
+    built once and reparameterized for every (p, r). Identical problems are
+    solved once, and every solve warm-starts from the values of the nearest
+    problem already solved on the same map.
+
+    Attributes:
+        grids (GridWorldBuilder): The grid worlds to sweep.
+        discount_factors (list): The discount factors to solve for.
+        ps (list): The slip probabilities, or None for each grid world's own p.
+        rs (list): The step rewards, or None for each grid world's own r.
+        theta (float): The threshold for stopping the iteration.
+        backup (str): The ValueIteration backup mode.
+        solves (int): The number of distinct problems solved by run().
+    """
+
+    def __init__(self, grids: GridWorldBuilder, discount_factors=(0.5,), ps=None, rs=None, theta=0.01, backup='sync'):
+        """
+        Initializes the sweep.
+
+        Args:
+            grids (GridWorldBuilder): The grid worlds to sweep.
+            discount_factors (list, optional): The discount factors to solve for. Default is (0.5,).
+            ps (list, optional): The slip probabilities. Default is each grid world's own p.
+            rs (list, optional): The step rewards. Default is each grid world's own r.
+            theta (float, optional): The threshold for stopping the iteration. Default is 0.01.
+            backup (str, optional): The ValueIteration backup mode. Default is 'sync'.
+        """
+        self.grids = grids
+        self.discount_factors = list(discount_factors)
+        self.ps = ps
+        self.rs = rs
+        self.theta = theta
+        self.backup = backup
+        self.solves = 0
+
+    def _maps(self):
+        """
+        Groups the grid world indices by map, i.e. by size and L.
+
+        Returns:
+            dict: The grid world indices of every distinct map.
+        """
+        maps = {}
+        for index, grid in enumerate(self.grids.grids):
+            key = (grid['w'], grid['h'], tuple(sorted(grid['L'].items())))
+            maps.setdefault(key, []).append(index)
+        return maps
+
+    def _problems(self, indices):
+        """
+        Lists the (p, r, discount factor) problems of the grid worlds sharing one map.
+
+        Returns:
+            dict: The grid world indices asking for every distinct problem.
+        """
+        problems = {}
+        for index in indices:
+            grid = self.grids.grids[index]
+            ps = [grid['p']] if self.ps is None else self.ps
+            rs = [grid['r']] if self.rs is None else self.rs
+            for problem in itertools.product(ps, rs, self.discount_factors):
+                problems.setdefault(problem, []).append(index)
+        return problems
+
+    @staticmethod
+    def _nearest(problem, solved, scale):
+        """
+        Finds the solved problem closest to the given one, each axis scaled by its range.
+        """
+        distance = lambda other: sum(((a - b) / s) ** 2 for a, b, s in zip(problem, other, scale))
+        return min(solved, key=distance) if solved else None
+
+    def run(self):
+        """
+        Solves every problem of the sweep.
+
+        Returns:
+            list: One result per grid world and problem, as dictionaries with the
+            grid index, p, r, discount_factor, values, policy, iterations and the
+            problem the solve was warm-started from.
+        """
+        results = []
+        self.solves = 0
+        for indices in self._maps().values():
+            problems = self._problems(indices)
+            scale = [max(np.ptp(axis), 1e-12) for axis in zip(*problems)]
+            self.grids.load(indices[0])
+            solved = {}
+            for problem in sorted(problems):
+                p, r, discount_factor = problem
+                if (p, r) != (self.grids.p, self.grids.r):
+                    self.grids.reparameterize(p, r)
+                start = self._nearest(problem, solved, scale)
+                solver = ValueIteration(self.grids, discount_factor, self.theta, self.backup,
+                                        values=None if start is None else solved[start])
+                solver.train()
+                solved[problem] = solver.values
+                self.solves += 1
+                for index in problems[problem]:
+                    results.append({'grid': index, 'p': p, 'r': r, 'discount_factor': discount_factor,
+                                    'values': solver.values, 'policy': solver.policy,
+                                    'iterations': len(solver.delta_history), 'warm_start': start})
+        return results
@@ -0,0 +1,77 @@
+import numpy as np
+
+
+class VecEnv:
+    """
+    Vectorized grid world environment that advances many independent episodes in lockstep.
+
+    Attributes:
+        step_table (np.ndarray): The next state for every state and action, shape (num_states, num_actions).
+        reward_vector (np.ndarray): The reward received when entering each state.
+        terminal (np.ndarray): Mask of the states that end an episode.
+        num_envs (int): The number of episodes run side by side.
+        states (np.ndarray): The current state of every episode.
+        rng (np.random.Generator): The random generator used for the start states.
+    """
+
+    def __init__(self, step_table, reward_vector, terminal, num_envs=256, seed=None):
+        """
+        Initialize the environments and draw their start states.
+
+        Args:
+            step_table (np.ndarray): The next state for every state and action.
+            reward_vector (np.ndarray): The reward received when entering each state.
+            terminal (np.ndarray): Mask of the states that end an episode.
+            num_envs (int): The number of episodes run side by side.
+            seed (int): Seed for the random generator.
+        """
+        self.step_table = step_table
+        self.reward_vector = reward_vector
+        self.terminal = terminal
+        self.num_envs = num_envs
+        self.rng = np.random.default_rng(seed)
+        self.start_states = np.flatnonzero(~terminal)
+        self.states = self.reset()
+
+    def sample_start_states(self, n):
+        """
+        Draw n start states uniformly among the non-terminal states.
+
+        Args:
+            n (int): The number of start states.
+
+        Returns:
+            np.ndarray: The start states.
+        """
+        return self.start_states[self.rng.integers(0, len(self.start_states), n)]
+
+    def reset(self):
+        """
+        Restart every episode from a random non-terminal state.
+
+        Returns:
+            np.ndarray: The start states.
+        """
+        self.states = self.sample_start_states(self.num_envs)
+        return self.states
+
+    def step(self, actions):
+        """
+        Take one action in every episode.
+
+        Episodes that reach a terminal state are restarted, so `states` holds
+        their new start state while the returned next states are the terminals.
+
+        Args:
+            actions (np.ndarray): The action taken in every episode.
+
+        Returns:
+            tuple: The next states, rewards and done flags of every episode.
+        """
+        next_states = self.step_table[self.states, actions]
+        rewards = self.reward_vector[next_states]
+        dones = self.terminal[next_states]
+        self.states = next_states.copy()
+        if dones.any():
+            self.states[dones] = self.sample_start_states(np.count_nonzero(dones))
+        return next_states, rewards, dones
@@ -1,25 +1,76 @@
+import argparse
+import ast
+import json
+import os
 from MBRL import ModelBasedRL
 from MDP import ValueIteration
 from MFRL import ModelFreeRL
 from GridWorldBuilder import *
+from Runner import SOLVERS, make_jobs, run_experiments
 
 
+def parse_params(items):
+    """
+    Parse repeated SOLVER.KEY=VALUE options into keyword arguments per solver.
+    """
+    params = {}
+    for item in items:
+        name, value = item.split('=', 1)
+        solver, key = name.split('.', 1)
+        params.setdefault(solver, {})[key] = ast.literal_eval(value)
+    return params
+
 
 if __name__=="__main__":
-    grids = GridWorldBuilder('GridWorld.py')
-    for grid in grids:
-        solver = ValueIteration(grids)
-        solver.train()
-        grids.visualize_value_policy(solver.policy,solver.values,True,solver.delta_history,solver.discount_factor)
+    parser = argparse.ArgumentParser(description='Solve the grid worlds of a definitions file.')
+    parser.add_argument('--file', default='GridWorld.py', help='grid world definitions file')
+    parser.add_argument('--headless', action='store_true', help='run every job on a process pool without plotting')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: CPU count)')
+    parser.add_argument('--solvers', nargs='+', default=list(SOLVERS), choices=SOLVERS)
+    parser.add_argument('--grids', type=int, nargs='+', help='indices of the grid worlds to solve (default: all)')
+    parser.add_argument('--param', action='append', default=[], metavar='SOLVER.KEY=VALUE',
+                        help='solver keyword argument, e.g. ModelFreeRL.episodes=200')
+    parser.add_argument('--seeds', type=int, default=1, help='number of seeds per grid and solver')
+    parser.add_argument('--seed', type=int, default=42, help='base seed the job seeds are spawned from')
+    parser.add_argument('--cache', help='directory of compiled grid worlds shared by runs and workers')
+    parser.add_argument('--output', help='write results as JSON lines to this file')
+    parser.add_argument('--render', metavar='DIR', help='write the values of every result as a PNG to this '
+                        'directory, with the policy of ValueIteration results')
+    args = parser.parse_args()
+
+    grids = GridWorldBuilder(args.file, cache_dir=args.cache)
+    if args.headless:
+        indices = args.grids if args.grids is not None else range(len(grids.grids))
+        jobs = make_jobs(args.file, indices, args.solvers, parse_params(args.param), args.seeds, args.seed,
+                         args.cache)
+        output = open(args.output, 'w') if args.output else None
+        for result in run_experiments(jobs, args.workers):
+            print(f"grid {result['grid']} {result['solver']} seed {result['seed']}: {result['seconds']:.3f}s")
+            if output:
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+            if args.render:
+                os.makedirs(args.render, exist_ok=True)
+                grid = grids[result['grid']]
+                policy = result['policy'] if result['solver'] == 'ValueIteration' else None
+                grid.render_value_policy(policy, result['values'], os.path.join(
+                    args.render, f"grid{result['grid']}_{result['solver']}_seed{result['seed']}.png"))
+        if output:
+            output.close()
+    else:
+        for grid in grids:
+            solver = ValueIteration(grids)
+            solver.train()
+            grids.visualize_value_policy(solver.policy,solver.values,True,solver.delta_history,solver.discount_factor)
 
 
         
-        agentM = ModelBasedRL(grids)
-        policy = agentM.iterative_policy_learning()
-        values = np.max(agentM.q_values, axis=1).reshape(agentM.grid.h, agentM.grid.w)
+            agentM = ModelBasedRL(grids)
+            policy = agentM.iterative_policy_learning()
+            values = agentM.compact.scatter(np.max(agentM.q_values, axis=1)).reshape(agentM.grid.h, agentM.grid.w)
         
         
-        agentF = ModelFreeRL(grids)
-        agentF.train()
-        values = agentF.get_values()
-        policy = agentF.get_policy()
\ No newline at end of file
+            agentF = ModelFreeRL(grids)
+            agentF.train()
+            values = agentF.get_values()
+            policy = agentF.get_policy()